@@ -0,0 +1,36 @@
+# hub/nutki2020.py as an animation for pack_frames.py:
+#   ./pack_frames.py animations/nutki2020.py && ./cp.py animations/nutki2020.frames
+# and upload hub/nutki2020_frames.py to play it.
+import random
+
+I = 550
+INTERVAL = 1
+NUTKI = [0, 403776, 338368, 462976, 340288, 135296, 0, 14760206, 15018318, 14760206, 15018318, 0, 0]
+LEVELS = ['2345623456', '2567899999', '0000023456', '8889988899']
+
+
+def t(v, m=5, n=5):
+    return 0 if v < 0 else n if v > m else v
+
+
+def frames():
+    random.seed(2020)
+    r = random.randint
+    frame = [[0] * 5 for _ in range(5)]
+    for i in range(I * 12):
+        x = r(0, 4)
+        y = r(0, 4)
+        p = i // I
+        q = lambda l: (i % I) // (I // l)
+        s = (NUTKI[p] >> (24 - x * 5 - y)) & 1
+        if p == 0:
+            levels = LEVELS[2][t(q(15) - x - y):]
+        elif p < 6:
+            levels = LEVELS[s][t(q(9)):]
+        elif p == 6:
+            levels = LEVELS[s + 2][t(x + q(6) - 3):]
+        else:
+            levels = LEVELS[s + 2][t(x + 2):]
+        # the original calls hub.display.pixel(y, x, ...)
+        frame[x][y] = int(levels[r(0, 4)])
+        yield frame
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Compares cp.py file transfer methods against the hub emulator.
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from cp import Repl
+from emulator import Emulator
+
+
+def bench(method, data, chunk, baudrate, latency):
+    with Emulator(baudrate, latency) as emulator:
+        if method == 'fast':
+            shutil.copy(os.path.join(ROOT, 'hub', 'fastxfer.py'), emulator.root)
+        repl = Repl.open(emulator.port)
+        repl.enter()
+        start = time.perf_counter()
+        if method == 'fast':
+            repl.put_fast(io.BytesIO(data), '/bench.bin', chunk)
+        elif method == 'raw':
+            repl.put_raw(io.BytesIO(data), '/bench.bin', chunk)
+        else:
+            repl.put_lines(io.BytesIO(data), '/bench.bin', chunk)
+        elapsed = time.perf_counter() - start
+        repl.close()
+        repl.ser.close()
+    return len(data) / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='cp.py transfer benchmark against the hub emulator')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200, help='emulated link speed (0: unthrottled)')
+    parser.add_argument('-l', '--latency', type=float, default=0.005, help='emulated hub response delay in seconds')
+    parser.add_argument('-s', '--size', type=int, default=32768, help='file size')
+    args = parser.parse_args()
+
+    data = os.urandom(args.size)
+    for method, chunk in [('line', 192), ('raw', 1024), ('raw', 4096), ('raw', 16384),
+                          ('fast', 1024), ('fast', 4096), ('fast', 16384)]:
+        print('%-4s %5d B chunks: %8.0f B/s' % (method, chunk, bench(method, data, chunk, args.baudrate, args.latency)))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Replays a stream of hub status frames through the frame parser and reports frames/sec.
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from spikejsonrpc import Framer, RPC
+
+
+def status_capture(n):
+    frames = []
+    for i in range(n):
+        if i % 10 == 9:
+            frames.append({'m': 2, 'p': [8.3, 100, False]})
+        else:
+            frames.append({'m': 0, 'p': [[48, [i % 360, 0, i % 360, 0]], [49, [0, 0, 0, 0]], [61, [i % 10, 0, 0, 0]],
+                                         [0, []], [62, [120]], [0, []], [i % 5, -12, 1022], [0, 0, i % 3],
+                                         [i % 180, 0, 2], '0000000000000000000000000', 0]})
+    return b''.join(json.dumps(f).encode('utf-8') + b'\r' for f in frames)
+
+
+# The framing done by RPC.recv_message before Framer was introduced.
+def split_concat(chunks):
+    buf = bytearray()
+    for chunk in chunks:
+        buf = buf + chunk
+        while True:
+            pos = buf.find(b'\x0d')
+            if pos < 0:
+                break
+            yield buf[:pos]
+            buf = buf[pos + 1:]
+
+
+def split_framer(chunks):
+    framer = Framer()
+    for chunk in chunks:
+        framer.feed(chunk)
+        yield from framer
+
+
+def run(name, split, chunks, parse):
+    start = time.perf_counter()
+    n = 0
+    for frame in split(chunks):
+        if parse:
+            RPC.parse_frame(frame)
+        n += 1
+    elapsed = time.perf_counter() - start
+    print("%-14s %8d frames %8.3fs %12.0f frames/s" % (name, n, elapsed, n / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Frame parser micro-benchmark')
+    parser.add_argument('-n', '--frames', type=int, default=20000, help='number of status frames to generate')
+    parser.add_argument('-c', '--chunk', type=int, action='append',
+                        help='bytes returned per serial read (default: 512, 4096 and 65536)')
+    parser.add_argument('--capture', help='replay raw bytes read from the hub instead of generated frames')
+    parser.add_argument('--parse', action='store_true', help='include JSON decoding')
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as f:
+            data = f.read()
+    else:
+        data = status_capture(args.frames)
+    for size in args.chunk or [512, 4096, 65536]:
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        print("%d bytes in %d reads of %d bytes" % (len(data), len(chunks), size))
+        run('concat+slice', split_concat, chunks, args.parse)
+        run('Framer', split_framer, chunks, args.parse)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Measures RPC latency, upload throughput and frame parser throughput against the hub emulator.
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from spikejsonrpc import RPC
+from emulator import Emulator
+from bench_framer import status_capture, split_framer
+
+
+def bench_latency(rpc, n):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        rpc.get_firmware_info()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {'mean_ms': statistics.mean(times) * 1000, 'p50_ms': times[len(times) // 2] * 1000,
+            'p95_ms': times[int(len(times) * 0.95)] * 1000}
+
+
+def bench_upload(rpc, size, window):
+    data = os.urandom(size)
+    start = time.perf_counter()
+    rpc.write_program(data, 0, 'bench.py', window=window)
+    return size / (time.perf_counter() - start)
+
+
+def bench_parser(n):
+    data = status_capture(n)
+    chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+    start = time.perf_counter()
+    for frame in split_framer(chunks):
+        RPC.parse_frame(frame)
+    return n / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='RPC benchmarks against the hub emulator')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200, help='emulated link speed (0: unthrottled)')
+    parser.add_argument('-l', '--latency', type=float, default=0.005, help='emulated hub response delay in seconds')
+    parser.add_argument('-n', '--calls', type=int, default=200, help='number of calls for the latency benchmark')
+    parser.add_argument('-s', '--size', type=int, default=32768, help='program size for the upload benchmark')
+    parser.add_argument('-w', '--window', type=int, action='append', help='upload window (default: 1, 4 and 8)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    with Emulator(args.baudrate, args.latency) as emulator:
+        rpc = RPC(emulator.port)
+        results['latency'] = bench_latency(rpc, args.calls)
+        print('get_firmware_info latency: mean %(mean_ms).2fms p50 %(p50_ms).2fms p95 %(p95_ms).2fms'
+              % results['latency'])
+        for window in args.window or [1, 4, 8]:
+            rate = bench_upload(rpc, args.size, window)
+            results['upload_window_%d_Bps' % window] = rate
+            print('upload window %2d: %8.0f B/s' % (window, rate))
+        rpc.ser.close()
+    results['parser_frames_per_s'] = bench_parser(20000)
+    print('frame parser: %.0f frames/s' % results['parser_frames_per_s'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
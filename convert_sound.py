@@ -4,17 +4,97 @@ import librosa
 import sys
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-parser = argparse.ArgumentParser(description='Converts sound files into Lego Spike Hub format.')
-parser.add_argument('file', help='input file')
-parser.add_argument('-s', '--start', type=float, help='start reading after this time (in seconds)', default=0)
-parser.add_argument('-d', '--duration', type=float, help='only load up to this much audio (in seconds)', default=None)
-args = parser.parse_args()
+SAMPLE_RATE = 16000
+EXTENSIONS = ('.wav', '.mp3', '.flac', '.ogg', '.aiff', '.aif', '.m4a')
 
-base, ext = os.path.splitext(args.file)
 
-x, sr = librosa.load(args.file, sr=16000, duration=args.duration, offset=args.start)
+def quantize(x):
+  return np.round((x + 1) / 2 * 4095).astype(np.int16)
 
-res = np.vectorize(lambda x: np.int16(np.round((x + 1)/2 * 4095)))(x)
 
-res.tofile(base + '.spike.bin')
+def output_name(file):
+  base, ext = os.path.splitext(file)
+  return base + '.spike.bin'
+
+
+def stream(file, start, duration, chunk):
+  # decodes and resamples chunk seconds at a time; the resampler keeps its state across blocks so the result
+  # matches resampling the whole file
+  import soxr
+  sr = librosa.get_samplerate(file)
+  hop = 4096
+  blocks = librosa.stream(file, block_length=max(1, int(chunk * sr / hop)), frame_length=hop, hop_length=hop,
+                          mono=True, offset=start, duration=duration, fill_value=None)
+  if sr == SAMPLE_RATE:
+    yield from blocks
+    return
+  resampler = soxr.ResampleStream(sr, SAMPLE_RATE, 1, dtype='float32')
+  for block in blocks:
+    yield resampler.resample_chunk(block)
+  yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+
+def convert(file, start=0, duration=None, chunk=10):
+  out = output_name(file)
+  tmp = out + '.tmp'
+  try:
+    with open(tmp, 'wb') as f:
+      try:
+        if not chunk:
+          raise ValueError
+        for block in stream(file, start, duration, chunk):
+          f.write(quantize(block).tobytes())
+      except Exception:
+        # formats soundfile cannot stream (or chunk == 0) are loaded in one go
+        f.seek(0)
+        f.truncate()
+        x, sr = librosa.load(file, sr=SAMPLE_RATE, duration=duration, offset=start)
+        f.write(quantize(x).tobytes())
+    os.replace(tmp, out)
+  except BaseException:
+    os.remove(tmp)
+    raise
+  return out
+
+
+def sound_files(dir):
+  for root, _, names in os.walk(dir):
+    for name in sorted(names):
+      if name.lower().endswith(EXTENSIONS):
+        yield os.path.join(root, name)
+
+
+def up_to_date(file):
+  out = output_name(file)
+  return os.path.exists(out) and os.path.getmtime(out) >= os.path.getmtime(file)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Converts sound files into Lego Spike Hub format.')
+  parser.add_argument('file', help='input file, or a directory to convert all sound files in it')
+  parser.add_argument('-s', '--start', type=float, help='start reading after this time (in seconds)', default=0)
+  parser.add_argument('-d', '--duration', type=float, help='only load up to this much audio (in seconds)', default=None)
+  parser.add_argument('-c', '--chunk', type=float, default=10,
+                      help='convert this many seconds at a time, 0 loads the whole file (default: 10)')
+  parser.add_argument('-j', '--jobs', type=int, help='number of files converted in parallel (default: CPU count)')
+  parser.add_argument('-f', '--force', action='store_true', help='convert even if the output is newer than the input')
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.file):
+    convert(args.file, args.start, args.duration, args.chunk)
+    sys.exit()
+
+  files = [f for f in sound_files(args.file) if args.force or not up_to_date(f)]
+  with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+    futures = [pool.submit(convert, f, args.start, args.duration, args.chunk) for f in files]
+    failed = 0
+    for file, future in zip(files, futures):
+      try:
+        print(future.result())
+      except Exception as e:
+        print('%s: %s' % (file, repr(e)), file=sys.stderr)
+        failed += 1
+  if failed:
+    sys.exit(1)
@@ -1,54 +1,545 @@
 #!/usr/bin/env python3
 import serial
 import base64
+import io
 import os
 import sys
+import ast
+import zlib
+import hashlib
+import struct
 import argparse
-from tqdm import tqdm
 import time
 
-parser = argparse.ArgumentParser(description='Sends files to Spike Hub file system')
-parser.add_argument('file', help='file name')
-parser.add_argument('dir', nargs='?', help='destination directory', default = '')
-parser.add_argument('-t', '--tty', help='Spike Hub device path', default='/dev/ttyACM0')
-args = parser.parse_args()
-
-path, file = os.path.split(args.file)
-size = os.path.getsize(args.file)
-
-ser = serial.Serial(args.tty, 115200, timeout = 0.1)
-
-def wait_for_prompt():
-  buf = b''
-  start_time = time.time()
-  elapsed = 0
-  while elapsed < 1:
-    c = ser.in_waiting
-    ser.timeout = 1 - elapsed
-    x = ser.read(c if c else 1)
-    buf = (buf + x)[-5:]
-    if buf == b'\n>>> ':
-      return
-    elapsed = time.time() - start_time
-  raise ConnectionError('failed to get to the command prompt (last characters: %s)' % buf)
-
-def write_command(cmd):
-  ser.write(cmd + b'\r\n')
-  wait_for_prompt()
-
-ser.write(b'\x03')
-wait_for_prompt()
-write_command(b'')
-write_command(b"import ubinascii")
-write_command(b"f = open('/%s/%s', 'wb')" % (args.dir.encode('utf8'), file.encode('utf8')))
-print('Copying "%s" to "%s/%s"' % (args.file, args.dir, file))
-with tqdm(total=size, unit='B', unit_scale=True) as pbar:
-  with open(args.file, "rb") as f:
-    byte = f.read(192)
+# Sets up the hub side of a raw REPL transfer: _w() appends a base64 chunk to the open file.
+PUT_SETUP = b"""import ubinascii
+_f = open(%r, 'wb')
+def _w(b):
+  _f.write(ubinascii.a2b_base64(b))
+"""
+
+# Reads the file back on the hub and prints its size and CRC-32.
+PUT_VERIFY = b"""_f.close()
+_n = 0
+_c = 0
+_f = open(%r, 'rb')
+while True:
+  _d = _f.read(1024)
+  if not _d:
+    break
+  _n += len(_d)
+  _c = ubinascii.crc32(_d, _c)
+_f.close()
+print(_n, _c & 0xffffffff)
+"""
+
+# Creates the given directories and prints (path, size, sha256) for every file whose size matches the local one,
+# (path, size) if the size differs and (path, -1) if the file is missing.
+SYNC_QUERY = b"""import uos, uhashlib, ubinascii
+for _d in %r:
+  try:
+    uos.mkdir(_d)
+  except OSError:
+    pass
+for _p, _s in %r:
+  try:
+    _n = uos.stat(_p)[6]
+  except OSError:
+    print((_p, -1))
+    continue
+  if _n != _s:
+    print((_p, _n))
+    continue
+  _h = uhashlib.sha256()
+  _f = open(_p, 'rb')
+  while True:
+    _b = _f.read(512)
+    if not _b:
+      break
+    _h.update(_b)
+  _f.close()
+  print((_p, _n, ubinascii.hexlify(_h.digest()).decode()))
+"""
+
+# Prints (path, size) for the entries below a directory, size -1 for directories.
+LIST_QUERY = b"""import uos
+def _l(d, r):
+  for _e in uos.ilistdir(d):
+    _p = d.rstrip('/') + '/' + _e[0]
+    if _e[1] & 0x4000:
+      print((_p, -1))
+      if r:
+        _l(_p, r)
+    else:
+      print((_p, _e[3] if len(_e) > 3 else uos.stat(_p)[6]))
+_l(%r, %r)
+"""
+
+# Prints the size of a file, then its content as base64 lines and finally its CRC-32.
+GET_FILE = b"""import uos, ubinascii
+print(uos.stat(%r)[6])
+_f = open(%r, 'rb')
+_c = 0
+while True:
+  _b = _f.read(%d)
+  if not _b:
+    break
+  _c = ubinascii.crc32(_b, _c)
+  print(ubinascii.b2a_base64(_b).decode().strip())
+_f.close()
+print('#', _c & 0xffffffff)
+"""
+
+
+class Repl:
+  def __init__(self, ser):
+    self.ser = ser
+    self.buf = b''
+    self.raw = False
+    self.use_raw_paste = True
+    # whether hub/fastxfer.py is installed on the hub, None until checked
+    self.fast = None
+
+  @staticmethod
+  def open(tty):
+    return Repl(serial.Serial(tty, 115200, timeout = 0.1))
+
+  def read_until(self, ending, timeout=1):
+    # returns the data up to and including ending, anything read past it is kept for the next call
+    start_time = time.time()
+    elapsed = 0
+    while True:
+      pos = self.buf.find(ending)
+      if pos >= 0:
+        pos += len(ending)
+        data, self.buf = self.buf[:pos], self.buf[pos:]
+        return data
+      if elapsed >= timeout:
+        break
+      c = self.ser.in_waiting
+      self.ser.timeout = timeout - elapsed
+      self.buf += self.ser.read(c if c else 1)
+      elapsed = time.time() - start_time
+    raise ConnectionError('timed out waiting for %r (last characters: %s)' % (ending, self.buf[-20:]))
+
+  def read(self, n, timeout=1):
+    if len(self.buf) < n:
+      self.ser.timeout = timeout
+      self.buf += self.ser.read(n - len(self.buf))
+    data, self.buf = self.buf[:n], self.buf[n:]
+    return data
+
+  def wait_for_prompt(self):
+    self.read_until(b'\n>>> ')
+
+  def write_command(self, cmd):
+    self.ser.write(cmd + b'\r\n')
+    self.wait_for_prompt()
+
+  def enter(self):
+    # leaves a raw REPL left behind by an earlier session, interrupts the running program and gets to the
+    # command prompt; the prompts printed on the way are skipped up to the output of a marker command
+    self.ser.write(b'\r\x02\x03')
+    self.wait_for_prompt()
+    self.ser.write(b"print('ent' 'ered')\r\n")
+    self.read_until(b'entered\r\n>>> ')
+    self.buf = b''
+    self.raw = False
+
+  def enter_raw(self):
+    if not self.raw:
+      self.ser.write(b'\x01')
+      self.read_until(b'raw REPL; CTRL-B to exit\r\n>')
+      self.raw = True
+
+  def exit_raw(self):
+    if self.raw:
+      self.ser.write(b'\x02')
+      self.wait_for_prompt()
+      self.raw = False
+
+  def close(self):
+    # soft reboot, the hub restarts its runtime
+    self.exit_raw()
+    self.ser.write(b'\x04')
+    self.ser.flush()
+
+  def write_raw(self, code):
+    if self.use_raw_paste:
+      self.ser.write(b'\x05A\x01')
+      data = self.read(2)
+      if data == b'R\x01':
+        return self.write_raw_paste(code)
+      if data != b'R\x00':
+        # no raw paste support, Ctrl-A restarted the raw REPL and the bytes read are the start of its prompt
+        self.buf = data + self.buf
+        self.read_until(b'raw REPL; CTRL-B to exit\r\n>')
+      self.use_raw_paste = False
+    # without flow control, keep the writes small enough for the hub to keep up
+    for i in range(0, len(code), 256):
+      self.ser.write(code[i:i + 256])
+      time.sleep(0.01)
+    self.ser.write(b'\x04')
+    if self.read(2) != b'OK':
+      raise ConnectionError('could not execute command')
+
+  def write_raw_paste(self, code):
+    # the hub grants a window of bytes at a time and sends \x01 whenever another window can be sent
+    window = struct.unpack('<H', self.read(2))[0]
+    remain = window
+    i = 0
+    while i < len(code):
+      start_time = time.time()
+      while remain == 0 or self.buf or self.ser.in_waiting:
+        c = self.read(1)
+        if c == b'' and time.time() - start_time < 10:
+          continue
+        if c == b'\x01':
+          remain += window
+        elif c == b'\x04':
+          self.ser.write(b'\x04')
+          return
+        else:
+          raise ConnectionError('unexpected data during raw paste: %r' % c)
+      b = code[i:i + remain]
+      self.ser.write(b)
+      remain -= len(b)
+      i += len(b)
+    self.ser.write(b'\x04')
+    self.read_until(b'\x04')
+
+  def exec_raw(self, code, timeout=10):
+    self.enter_raw()
+    self.write_raw(code)
+    out = self.read_until(b'\x04', timeout)[:-1]
+    err = self.read_until(b'\x04', timeout)[:-1]
+    self.read_until(b'>', timeout)
+    if err:
+      raise ConnectionError(err.decode('utf-8', 'replace'))
+    return out
+
+  def put_lines(self, f, remote, chunk_size=192, progress=None):
+    # one REPL command per chunk, waiting for the prompt every time
+    self.exit_raw()
+    self.write_command(b"import ubinascii")
+    self.write_command(b"f = open('%s', 'wb')" % remote.encode('utf8'))
+    byte = f.read(chunk_size)
+    while len(byte) > 0:
+      self.write_command(b"f.write(ubinascii.a2b_base64('%s'))" % base64.b64encode(byte))
+      if progress:
+        progress(len(byte))
+      byte = f.read(chunk_size)
+    self.write_command(b"f.close()")
+
+  def has_fastxfer(self):
+    if self.fast is None:
+      try:
+        self.exec_raw(b'import fastxfer')
+        self.fast = True
+      except ConnectionError:
+        self.fast = False
+    return self.fast
+
+  def put(self, f, remote, chunk_size=4096, progress=None):
+    if self.has_fastxfer():
+      self.put_fast(f, remote, chunk_size, progress)
+    else:
+      self.put_raw(f, remote, chunk_size, progress)
+
+  def put_fast(self, f, remote, chunk_size=4096, progress=None):
+    # binary chunks with a CRC-32 each, received by fastxfer.receive() on the hub (see hub/fastxfer.py)
+    self.enter_raw()
+    self.write_raw(b'import fastxfer\nfastxfer.receive(%r)' % remote)
+    if self.read(1, 10) != b'R':
+      raise ConnectionError('fastxfer did not start: %r' % self.read_until(b'\x04>', 10))
+    size = 0
+    crc = 0
+    receiving = True
+    try:
+      # chunks are at most 0xfffe bytes, a length of 0xffff aborts the transfer
+      byte = f.read(min(chunk_size, 0xfffe))
+      while len(byte) > 0:
+        frame = struct.pack('<H', len(byte)) + byte + struct.pack('<I', zlib.crc32(byte))
+        for attempt in range(3):
+          self.ser.write(frame)
+          reply = self.read(1, 10)
+          if reply == b'K':
+            break
+          if reply == b'\x04':
+            # the hub gave up on the transfer, the rest is its error message
+            receiving = False
+            err = self.read_until(b'\x04', 10)[:-1]
+            self.read_until(b'>', 10)
+            raise ConnectionError(err.decode('utf-8', 'replace'))
+          if reply != b'E':
+            raise ConnectionError('unexpected reply from fastxfer: %r' % reply)
+        else:
+          raise ConnectionError('chunk of %s failed CRC check 3 times' % remote)
+        size += len(byte)
+        crc = zlib.crc32(byte, crc)
+        if progress:
+          progress(len(byte))
+        byte = f.read(min(chunk_size, 0xfffe))
+      self.ser.write(b'\0\0')
+      receiving = False
+    finally:
+      if receiving:
+        # between chunks the hub aborts right away, inside a chunk it gives up when no more data arrives;
+        # either way it removes the partial file and returns to the raw REPL prompt
+        self.ser.write(struct.pack('<H', 0xffff))
+        try:
+          self.read_until(b'\x04>', 10)
+        except ConnectionError:
+          pass
+    out = self.read_until(b'\x04', 10)[:-1]
+    err = self.read_until(b'\x04', 10)[:-1]
+    self.read_until(b'>', 10)
+    if err:
+      raise ConnectionError(err.decode('utf-8', 'replace'))
+    if [int(x) for x in out.split()] != [size, crc]:
+      raise ConnectionError('verification of %s failed: hub has %s, expected %d bytes with CRC %d'
+                            % (remote, out.decode(), size, crc))
+
+  def put_raw(self, f, remote, chunk_size=4096, progress=None):
+    # raw REPL transfer of large chunks, verified by size and CRC-32 of the file written on the hub
+    self.exec_raw(PUT_SETUP % remote)
+    size = 0
+    crc = 0
+    byte = f.read(chunk_size)
     while len(byte) > 0:
-      write_command(b"f.write(ubinascii.a2b_base64('%s'))" % base64.b64encode(byte))
-      pbar.update(len(byte))
-      byte = f.read(192)
-write_command(b"f.close()")
-ser.write(b'\x04')
-ser.flush()
+      self.exec_raw(b"_w(b'%s')" % base64.b64encode(byte))
+      size += len(byte)
+      crc = zlib.crc32(byte, crc)
+      if progress:
+        progress(len(byte))
+      byte = f.read(chunk_size)
+    result = self.exec_raw(PUT_VERIFY % remote).split()
+    if [int(x) for x in result] != [size, crc]:
+      raise ConnectionError('verification of %s failed: hub has %s bytes with CRC %s, expected %d bytes with CRC %d'
+                            % (remote, result[0].decode(), result[1].decode(), size, crc))
+
+  def sync(self, local_dir, remote_dir, chunk_size=4096, progress=None, total=None):
+    # copies the files of the local tree that are missing or differ on the hub; the hub is asked for the
+    # sizes and hashes of all files in a single command. Returns the list of (remote path, copied).
+    # the parents of a nested remote_dir are created first, uos.mkdir does not create them
+    parts = remote_dir.strip('/').split('/')
+    dirs = ['/' + '/'.join(parts[:i]) for i in range(1, len(parts))] if remote_dir.strip('/') else []
+    files = {}
+    for root, subdirs, names in os.walk(local_dir):
+      # skip bytecode caches and hidden files and directories
+      subdirs[:] = sorted(d for d in subdirs if d != '__pycache__' and not d.startswith('.'))
+      rel = os.path.relpath(root, local_dir)
+      remote_root = remote_path(remote_dir, '' if rel == '.' else rel.replace(os.sep, '/')).rstrip('/')
+      if remote_root:
+        dirs.append(remote_root)
+      for name in sorted(names):
+        if not name.startswith('.') and not name.endswith('.pyc'):
+          files[remote_root + '/' + name] = os.path.join(root, name)
+    local = {remote: (os.path.getsize(path), path) for remote, path in files.items()}
+    if total:
+      total(sum(size for size, _ in local.values()))
+    query = [(remote, size) for remote, (size, _) in local.items()]
+    remote = {}
+    for line in self.exec_raw(SYNC_QUERY % (dirs, query), timeout=60).splitlines():
+      if line.strip():
+        entry = ast.literal_eval(line.decode('utf-8'))
+        remote[entry[0]] = entry[1:]
+    results = []
+    for path, (size, file) in local.items():
+      with open(file, 'rb') as f:
+        if len(remote.get(path, ())) == 2 and remote[path][1] == hashlib.sha256(f.read()).hexdigest():
+          if progress:
+            progress(size)
+          results.append((path, False))
+          continue
+        f.seek(0)
+        self.put(f, path, chunk_size, progress)
+      results.append((path, True))
+    return results
+
+
+  def listdir(self, path='/', recursive=False):
+    # returns the list of (path, size) below path, size -1 for directories, in a single command
+    out = self.exec_raw(LIST_QUERY % (path, recursive), timeout=60)
+    return [ast.literal_eval(line.decode('utf-8')) for line in out.splitlines() if line.strip()]
+
+  def get(self, remote, f, chunk_size=4096, progress=None, total=None):
+    # streams a file from the hub into f chunk by chunk, verified by its size and CRC-32
+    self.enter_raw()
+    self.write_raw(GET_FILE % (remote, remote, chunk_size))
+    size = None
+    n = 0
+    crc = 0
+    while True:
+      line = self.read_until(b'\n', 10)
+      if b'\x04' in line:
+        # the output ended early, the rest is the error message
+        err = line[line.index(b'\x04') + 1:] + self.read_until(b'\x04', 10)[:-1]
+        self.read_until(b'>', 10)
+        raise ConnectionError(err.decode('utf-8', 'replace'))
+      line = line.strip()
+      if size is None:
+        size = int(line)
+        if total:
+          total(size)
+      elif line.startswith(b'#'):
+        break
+      else:
+        data = base64.b64decode(line)
+        f.write(data)
+        n += len(data)
+        crc = zlib.crc32(data, crc)
+        if progress:
+          progress(len(data))
+    self.read_until(b'\x04', 10)
+    self.read_until(b'\x04', 10)
+    self.read_until(b'>', 10)
+    if [n, crc] != [size, int(line[1:])]:
+      raise ConnectionError('verification of %s failed: got %d bytes with CRC %d, hub has %d bytes with CRC %s'
+                            % (remote, n, crc, size, line[1:].decode().strip()))
+
+
+def remote_path(dir, file):
+  return '/%s/%s' % (dir.strip('/'), file) if dir.strip('/') else '/' + file
+
+
+if __name__ == "__main__":
+  from tqdm import tqdm
+
+  common = argparse.ArgumentParser(add_help=False)
+  common.add_argument('-t', '--tty', help='Spike Hub device path', default='/dev/ttyACM0')
+  common.add_argument('--capture', metavar='FILE', help='record the serial traffic to a trace file')
+  common.add_argument('--replay', metavar='FILE', help='play back a trace file instead of talking to the hub')
+  common.add_argument('--replay-fast', action='store_true', help='play back as fast as possible')
+
+  # cp.py pull and cp.py ls copy from and list the hub file system, anything else copies to it
+  mode = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in ('pull', 'ls') else None
+  if mode == 'pull':
+    parser = argparse.ArgumentParser(prog='cp.py pull', description='Copies files from Spike Hub file system',
+                                     parents=[common])
+    parser.add_argument('remote', help='file on the hub (directory with -r)')
+    parser.add_argument('local', nargs='?', help='destination file or directory', default='.')
+    parser.add_argument('-r', '--recursive', action='store_true', help='copy a directory tree')
+    parser.add_argument('-c', '--chunk', type=int, default=4096, help='bytes per line of output (default: 4096)')
+  elif mode == 'ls':
+    parser = argparse.ArgumentParser(prog='cp.py ls', description='Lists Spike Hub file system', parents=[common])
+    parser.add_argument('path', nargs='?', help='directory (default: /)', default='/')
+    parser.add_argument('-r', '--recursive', action='store_true', help='list subdirectories too')
+  else:
+    parser = argparse.ArgumentParser(description='Sends files to Spike Hub file system', parents=[common])
+    parser.add_argument('file', help='file name (directory with --sync)')
+    parser.add_argument('dir', nargs='?', help='destination directory', default = '')
+    parser.add_argument('-m', '--method', choices=['fast', 'raw', 'line'], default='fast',
+                        help='transfer binary chunks when hub/fastxfer.py is installed on the hub and through the raw '
+                             'REPL otherwise (default), only through the raw REPL or one command per line')
+    parser.add_argument('-c', '--chunk', type=int, help='bytes per command (default: 4096 raw, 192 line)')
+    parser.add_argument('-s', '--sync', action='store_true',
+                        help='copy the files of a directory tree that are missing or changed on the hub')
+    parser.add_argument('--minify', action='store_true',
+                        help='remove comments, docstrings and whitespace from a .py file')
+    parser.add_argument('--mpy', action='store_true',
+                        help='minify and compile a .py file to .mpy when mpy-cross is installed')
+  args = parser.parse_args(sys.argv[2:] if mode else None)
+
+  def open_repl():
+    if args.replay:
+      from serialtrace import ReplaySerial
+      return Repl(ReplaySerial(args.replay, args.replay_fast))
+    repl = Repl.open(args.tty)
+    if args.capture:
+      from serialtrace import CaptureSerial
+      repl.ser = CaptureSerial(repl.ser, args.capture)
+    return repl
+
+  if mode == 'ls':
+    repl = open_repl()
+    try:
+      repl.enter()
+      entries = repl.listdir(args.path, args.recursive)
+    finally:
+      # never leave the hub in the raw REPL
+      repl.close()
+      if args.capture:
+        repl.ser.close()
+    for path, size in entries:
+      print('%8s %s' % ('' if size < 0 else size, path + '/' if size < 0 else path))
+    sys.exit()
+
+  if mode == 'pull':
+    repl = open_repl()
+    try:
+      repl.enter()
+      if args.recursive:
+        # listdir returns paths starting with the directory as given, so it is made absolute to strip it
+        root = '/' + args.remote.strip('/')
+        prefix = root.rstrip('/') + '/'
+        entries = repl.listdir(root, True)
+        files = [(p, os.path.join(args.local, *p[len(prefix):].split('/')))
+                 for p, size in entries if size >= 0]
+        total = sum(size for _, size in entries if size >= 0)
+      else:
+        local = args.local
+        if os.path.isdir(local):
+          local = os.path.join(local, args.remote.rstrip('/').split('/')[-1])
+        files = [(args.remote, local)]
+        total = None
+      with tqdm(total=total, unit='B', unit_scale=True) as pbar:
+        for remote, local in files:
+          if os.path.dirname(local):
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+          try:
+            with open(local + '.part', 'wb') as f:
+              repl.get(remote, f, args.chunk, pbar.update, None if total else lambda n: pbar.reset(total=n))
+          except BaseException:
+            # leave no partial file
+            os.remove(local + '.part')
+            raise
+          os.replace(local + '.part', local)
+    finally:
+      repl.close()
+      if args.capture:
+        repl.ser.close()
+    for remote, local in files:
+      print('%s -> %s' % (remote, local))
+    sys.exit()
+
+  if args.sync:
+    repl = open_repl()
+    try:
+      repl.enter()
+      with tqdm(unit='B', unit_scale=True) as pbar:
+        results = repl.sync(args.file, args.dir, args.chunk or 4096, pbar.update, lambda n: pbar.reset(total=n))
+    finally:
+      repl.close()
+      if args.capture:
+        repl.ser.close()
+    for path, copied in results:
+      print('%-8s %s' % ('copied' if copied else 'same', path))
+    print('%d of %d files copied' % (sum(copied for _, copied in results), len(results)))
+    sys.exit()
+
+  path, file = os.path.split(args.file)
+  with open(args.file, "rb") as f:
+    data = f.read()
+  if (args.minify or args.mpy) and file.endswith('.py'):
+    from minify import prepare
+    data, ext = prepare(data, file, args.mpy)
+    file = file[:-3] + ext
+  remote = remote_path(args.dir, file)
+
+  repl = open_repl()
+  try:
+    repl.enter()
+    print('Copying "%s" to "%s"' % (args.file, remote))
+    with tqdm(total=len(data), unit='B', unit_scale=True) as pbar:
+      with io.BytesIO(data) as f:
+        if args.method == 'fast':
+          repl.put(f, remote, args.chunk or 4096, pbar.update)
+        elif args.method == 'raw':
+          repl.put_raw(f, remote, args.chunk or 4096, pbar.update)
+        else:
+          repl.put_lines(f, remote, args.chunk or 192, pbar.update)
+  finally:
+    repl.close()
+    if args.capture:
+      repl.ser.close()
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+# Emulates a Spike Hub on a pseudo-terminal, for running the tools and benchmarks without a hub. It speaks the
+# JSON RPC protocol used by spikejsonrpc.RPC, sends periodic state frames and serves the MicroPython REPL
+# used by cp.py, with a local directory standing in for the hub file system.
+import os
+import sys
+import tty
+import fcntl
+import termios
+import json
+import time
+import base64
+import queue
+import random
+import select
+import shutil
+import struct
+import argparse
+import types
+import builtins
+import binascii
+import hashlib
+import tempfile
+import threading
+import traceback
+import contextlib
+
+from spikejsonrpc import Framer, RPC
+
+PASTE_WINDOW = 256
+# state frames are dropped while this many bytes wait unread on the port, e.g. with no client connected
+STATE_BACKLOG = 1024
+BANNER = b'MicroPython v1.12-emulator on 2020-01-01; LEGO Technic Large Hub with STM32F413xx\r\n' \
+         b'Type "help()" for more information.\r\n'
+
+
+class Emulator:
+    def __init__(self, baudrate=None, latency=0, state_interval=0.1, root=None, blocksize=512,
+                 program_output=None, loss=0, raw_paste=True):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.state_interval = state_interval
+        self.blocksize = blocksize
+        # fraction of JSON RPC responses that are dropped, to emulate a lossy link
+        self.loss = loss
+        # whether the raw REPL supports raw paste mode (MicroPython 1.14 and later)
+        self.raw_paste = raw_paste
+        # program_output(slot) returns the strings a started program prints
+        self.program_output = program_output or (lambda slot: ['Hello from slot %d\n' % slot])
+        self.root = root or tempfile.mkdtemp(prefix='spike-emulator-')
+        self.own_root = root is None
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.framer = Framer()
+        self.slots = {}
+        self.transfers = {}
+        self.display = '0' * 25
+        self.acks = {}
+        self.repl = None
+        self.repl_buf = bytearray()
+        self.repl_globals = {}
+        self.outbox = queue.Queue()
+        self.running = False
+        self.threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.read_loop, daemon=True),
+                        threading.Thread(target=self.write_loop, daemon=True),
+                        threading.Thread(target=self.state_loop, daemon=True)]
+        for t in self.threads:
+            t.start()
+
+    def stop(self):
+        self.running = False
+        for t in self.threads:
+            t.join()
+        os.close(self.master)
+        os.close(self.slave)
+        if self.own_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, data, delay=0):
+        self.outbox.put((time.time() + delay, data))
+
+    def write_loop(self):
+        # writes in order, each no earlier than its due time, at the emulated baud rate
+        while self.running:
+            try:
+                due, data = self.outbox.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            if due > time.time():
+                time.sleep(due - time.time())
+            if self.baudrate:
+                time.sleep(len(data) * 10 / self.baudrate)
+            os.write(self.master, data)
+
+    def send(self, msg, delay=0):
+        self.write(json.dumps(msg).encode('utf-8') + b'\r', delay)
+
+    def read_loop(self):
+        while self.running:
+            if not select.select([self.master], [], [], 0.05)[0]:
+                continue
+            data = os.read(self.master, 4096)
+            if self.baudrate:
+                time.sleep(len(data) * 10 / self.baudrate)
+            if self.repl is not None:
+                self.repl_input(data)
+                continue
+            idx = data.find(b'\x03')
+            if idx >= 0:
+                self.enter_repl()
+                self.repl_input(data[idx + 1:])
+                continue
+            self.framer.feed(data)
+            for frame in self.framer:
+                msg = RPC.parse_frame(frame)
+                if msg is not None:
+                    self.dispatch(msg)
+
+    def backlog(self):
+        # bytes written but not read by the client yet
+        return struct.unpack('i', fcntl.ioctl(self.slave, termios.FIONREAD, b'\0\0\0\0'))[0]
+
+    def state_loop(self):
+        # like a hub without a host reading its port, frames that cannot be delivered are not queued up
+        n = 0
+        while self.running:
+            time.sleep(self.state_interval)
+            if self.repl is not None or not self.outbox.empty() or self.backlog() >= STATE_BACKLOG:
+                continue
+            n += 1
+            motor = [n % 100, n % 360, n % 360 - 180, 0]
+            self.send({'m': 0, 'p': [[48, motor], [0, []], [61, [None, -1, 0, 0]], [0, []], [0, []], [0, []],
+                                     [0, 0, 1024], [0, 0, 0], [n % 180, 0, 0], self.display, n * 100]})
+            if n % 10 == 0:
+                self.send({'m': 2, 'p': [8.3, 100, False]})
+
+    # JSON RPC
+
+    def dispatch(self, msg):
+        if 'm' not in msg:
+            if msg.get('i') in self.acks:
+                self.acks[msg['i']].set()
+            return
+        handler = getattr(self, 'rpc_' + msg['m'].replace('.', '_'), None)
+        try:
+            if handler is None:
+                raise ValueError('Unknown method %s' % msg['m'])
+            result = handler(**msg.get('p', {}))
+        except Exception as e:
+            error = {'message': '%s: %s' % (type(e).__name__, e)}
+            self.send({'i': msg['i'], 'e': str(base64.b64encode(json.dumps(error).encode('utf-8')), 'utf-8')},
+                      self.latency)
+            return
+        if self.loss and random.random() < self.loss:
+            return
+        self.send({'i': msg['i'], 'r': result}, self.latency)
+
+    def rpc_get_firmware_info(self):
+        return {'version': [1, 0, 6, 34], 'runtime': [2, 1, 4, 8], 'checksum': '0000', 'capabilities': 0}
+
+    def rpc_trigger_current_state(self):
+        return None
+
+    def rpc_get_storage_status(self):
+        used = sum(s['size'] for s in self.slots.values()) // 1024
+        return {'storage': {'available': 31744 - used, 'total': 31744, 'pct': used * 100 / 31744,
+                            'unit': 'kb', 'free': 31744 - used},
+                'slots': {str(k): {key: v for key, v in s.items() if key != 'data'} for k, s in self.slots.items()}}
+
+    def rpc_start_write_program(self, slotid, size, meta):
+        transferid = RPC.random_id()
+        self.transfers[transferid] = {'slotid': slotid, 'size': size, 'meta': meta, 'data': bytearray()}
+        return {'blocksize': self.blocksize, 'transferid': transferid}
+
+    def rpc_write_package(self, data, transferid):
+        t = self.transfers[transferid]
+        t['data'] += base64.b64decode(data)
+        if len(t['data']) >= t['size']:
+            del self.transfers[transferid]
+            meta = t['meta']
+            self.slots[t['slotid']] = dict(meta, size=len(t['data']), id=random.randint(1000, 65535),
+                                           data=bytes(t['data']))
+        return {'next_ptr': len(t['data'])}
+
+    def rpc_move_project(self, old_slotid, new_slotid):
+        self.slots[new_slotid] = self.slots.pop(old_slotid)
+
+    def rpc_remove_project(self, slotid):
+        self.slots.pop(slotid, None)
+
+    def rpc_program_modechange(self, mode):
+        return None
+
+    def rpc_program_execute(self, slotid):
+        threading.Thread(target=self.run_program, args=(slotid,), daemon=True).start()
+        return None
+
+    def rpc_program_terminate(self):
+        return None
+
+    def rpc_scratch_display_image(self, image):
+        self.display = image.replace(':', '')
+
+    def rpc_scratch_display_image_for(self, image, duration):
+        self.display = image.replace(':', '')
+
+    def rpc_scratch_display_set_pixel(self, x, y, brightness):
+        i = y * 5 + x
+        self.display = self.display[:i] + str(brightness) + self.display[i + 1:]
+
+    def rpc_scratch_display_clear(self):
+        self.display = '0' * 25
+
+    def rpc_scratch_display_text(self, text):
+        return None
+
+    def run_program(self, slot):
+        # the hub waits for every print to be acknowledged before continuing
+        time.sleep(0.01)
+        for text in self.program_output(slot):
+            id = RPC.random_id()
+            self.acks[id] = threading.Event()
+            self.send({'m': 'userProgram.print', 'p': {'value': str(base64.b64encode(text.encode('utf-8')), 'utf-8')},
+                       'i': id})
+            self.acks[id].wait(1)
+            del self.acks[id]
+
+    # REPL
+
+    def enter_repl(self):
+        self.repl = 'friendly'
+        self.repl_buf = bytearray()
+        self.write(b'\r\nKeyboardInterrupt: \r\n' + BANNER + b'>>> ')
+
+    def repl_input(self, data):
+        for c in data:
+            if self.repl == 'friendly':
+                self.friendly_input(c)
+            elif self.repl == 'raw':
+                self.raw_input(c)
+            elif self.repl == 'paste-request':
+                self.repl_buf.append(c)
+                if len(self.repl_buf) == 2:
+                    self.repl_buf = bytearray()
+                    self.repl = 'paste'
+                    self.write(b'R\x01' + struct.pack('<H', PASTE_WINDOW))
+            elif self.repl == 'paste':
+                self.paste_input(c)
+            else:
+                return
+
+    def friendly_input(self, c):
+        if c == 0x01:
+            self.repl = 'raw'
+            self.repl_buf = bytearray()
+            self.write(b'raw REPL; CTRL-B to exit\r\n>')
+        elif c == 0x02:
+            self.repl_buf = bytearray()
+            self.write(b'\r\n' + BANNER + b'>>> ')
+        elif c == 0x03:
+            self.repl_buf = bytearray()
+            self.write(b'\r\nKeyboardInterrupt: \r\n>>> ')
+        elif c == 0x04:
+            self.soft_reboot()
+        elif c == 0x0a:
+            pass
+        elif c == 0x0d:
+            line = bytes(self.repl_buf).decode('utf-8')
+            self.repl_buf = bytearray()
+            self.write(line.encode('utf-8') + b'\r\n', self.latency)
+            err = self.execute(line, 'single')
+            self.write(err + b'>>> ', self.latency)
+        else:
+            self.repl_buf.append(c)
+
+    def raw_input(self, c):
+        if c == 0x01 and not self.raw_paste:
+            # before raw paste mode, Ctrl-A restarts the raw REPL
+            self.repl_buf = bytearray()
+            self.write(b'raw REPL; CTRL-B to exit\r\n>')
+        elif c == 0x02:
+            self.repl = 'friendly'
+            self.repl_buf = bytearray()
+            self.write(b'\r\n' + BANNER + b'>>> ')
+        elif c == 0x04:
+            if not self.repl_buf:
+                self.soft_reboot()
+                return
+            self.write(b'OK')
+            self.run_raw()
+        elif c == 0x05 and not self.repl_buf and self.raw_paste:
+            self.repl = 'paste-request'
+        else:
+            self.repl_buf.append(c)
+
+    def paste_input(self, c):
+        if c == 0x04:
+            self.write(b'\x04')
+            self.repl = 'raw'
+            self.run_raw()
+            return
+        self.repl_buf.append(c)
+        if len(self.repl_buf) % PASTE_WINDOW == 0:
+            self.write(b'\x01')
+
+    def run_raw(self):
+        code = bytes(self.repl_buf).decode('utf-8')
+        self.repl_buf = bytearray()
+        err = self.execute(code)
+        self.write(b'\x04' + err + b'\x04>', self.latency)
+
+    def soft_reboot(self):
+        self.repl = None
+        self.repl_buf = bytearray()
+        self.write(b'MPY: soft reboot\r\n')
+
+    def execute(self, code, mode='exec'):
+        # output is sent as it is printed, the error message is returned
+        out = types.SimpleNamespace(write=lambda text: self.write(text.replace('\n', '\r\n').encode('utf-8'),
+                                                                  self.latency),
+                                    flush=lambda: None)
+        err = ''
+        with contextlib.redirect_stdout(out):
+            try:
+                if code.strip():
+                    exec(compile(code, '<stdin>', mode), self.namespace())
+            except Exception as e:
+                tb = traceback.extract_tb(e.__traceback__)[-1]
+                err = 'Traceback (most recent call last):\n  File "<stdin>", line %d, in <module>\n%s: %s\n' \
+                      % (tb.lineno, type(e).__name__, e)
+        return err.replace('\n', '\r\n').encode('utf-8')
+
+    def namespace(self):
+        if not self.repl_globals:
+            fs = HubFS(self.root)
+            hub_sys = HubSys(self)
+            modules = {'ubinascii': binascii, 'binascii': binascii, 'uhashlib': hashlib, 'hashlib': hashlib,
+                       'uos': fs, 'os': fs, 'utime': time, 'time': time, 'sys': hub_sys, 'usys': hub_sys,
+                       'micropython': types.SimpleNamespace(kbd_intr=lambda c: None)}
+            hub_select = types.SimpleNamespace(POLLIN=1, poll=lambda: HubPoll(self))
+            modules.update(uselect=hub_select, select=hub_select)
+            hub_builtins = {}
+
+            def hub_import(name, *args, **kwargs):
+                if name not in modules and os.path.isfile(fs.path(name + '.py')):
+                    # modules stored in the hub file system
+                    module = types.ModuleType(name)
+                    module.__builtins__ = hub_builtins
+                    with fs.open(name + '.py') as f:
+                        exec(compile(f.read(), name + '.py', 'exec'), module.__dict__)
+                    modules[name] = module
+                if name in modules:
+                    return modules[name]
+                return builtins.__import__(name, *args, **kwargs)
+            hub_builtins.update(builtins.__dict__, __import__=hub_import, open=fs.open)
+            self.repl_globals['__builtins__'] = hub_builtins
+        return self.repl_globals
+
+
+# sys for code run on the REPL: stdin.buffer reads the serial link directly and stdout.write sends its data as
+# it is, without the delay and newline translation of print output.
+class HubSys:
+    def __init__(self, emulator):
+        self.stdin = types.SimpleNamespace(buffer=types.SimpleNamespace(read=self.read))
+        self.stdout = types.SimpleNamespace(write=self.write, flush=lambda: None)
+        self.emulator = emulator
+        # transfer time of the bytes read but not slept for yet, so that small reads are not slowed down by the
+        # overhead of sleeping
+        self.delay = 0
+
+    def __getattr__(self, name):
+        return getattr(sys, name)
+
+    def read(self, n):
+        data = b''
+        while len(data) < n and self.emulator.running:
+            if select.select([self.emulator.master], [], [], 0.05)[0]:
+                data += os.read(self.emulator.master, n - len(data))
+        if self.emulator.baudrate:
+            self.delay += len(data) * 10 / self.emulator.baudrate
+            if self.delay >= 0.005:
+                time.sleep(self.delay)
+                self.delay = 0
+        return data
+
+    def write(self, text):
+        self.emulator.write(text.encode('utf-8') if isinstance(text, str) else text)
+        return len(text)
+
+
+# uselect.poll for code run on the REPL, with the serial link as the only stream.
+class HubPoll:
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def register(self, stream, events=1):
+        pass
+
+    def poll(self, timeout=-1):
+        ready = select.select([self.emulator.master], [], [], None if timeout < 0 else timeout / 1000)[0]
+        return [(sys.stdin, 1)] if ready else []
+
+
+# The subset of uos used by the tools, rooted at a local directory.
+class HubFS:
+    def __init__(self, root):
+        self.root = root
+        self.sep = '/'
+
+    def path(self, path):
+        return os.path.join(self.root, os.path.normpath('/' + path).lstrip('/'))
+
+    def open(self, path, mode='r'):
+        return open(self.path(path), mode)
+
+    def listdir(self, path='/'):
+        return sorted(os.listdir(self.path(path)))
+
+    def ilistdir(self, path='/'):
+        for name in self.listdir(path):
+            st = os.stat(os.path.join(self.path(path), name))
+            yield name, 0x4000 if os.path.isdir(os.path.join(self.path(path), name)) else 0x8000, 0, st.st_size
+
+    def stat(self, path):
+        st = os.stat(self.path(path))
+        return (0x4000 if os.path.isdir(self.path(path)) else 0x8000, 0, 0, 0, 0, 0, st.st_size, 0, 0, 0)
+
+    def mkdir(self, path):
+        os.mkdir(self.path(path))
+
+    def remove(self, path):
+        os.remove(self.path(path))
+
+    def rename(self, old, new):
+        os.rename(self.path(old), self.path(new))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Emulates a Spike Hub on a pseudo-terminal')
+    parser.add_argument('-b', '--baudrate', type=int, help='throttle the link to this many baud')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='delay before each response (in seconds)')
+    parser.add_argument('--loss', type=float, default=0, help='fraction of responses dropped (default: 0)')
+    parser.add_argument('-r', '--root', help='directory holding the hub file system (default: temporary)')
+    parser.add_argument('--no-raw-paste', action='store_true',
+                        help='answer like MicroPython before 1.14, without raw paste mode in the raw REPL')
+    args = parser.parse_args()
+
+    with Emulator(args.baudrate, args.latency, root=args.root, loss=args.loss,
+                  raw_paste=not args.no_raw_paste) as emulator:
+        print('Emulating hub on %s' % emulator.port)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,25 @@
+# Runs on the hub: measures frames per second and memory allocated per frame when playing a frame table with
+# frames.play, and for comparison when computing the same animation on the hub as hub/nutki2020.py does. Needs
+# frames.py, nutki2020.py and nutki2020.frames on the hub.
+import gc
+import time
+import frames
+import nutki2020
+
+N = 500
+
+def bench(name, gen, n = N):
+  gc.collect()
+  gc.disable()
+  alloc = gc.mem_alloc()
+  start = time.ticks_us()
+  for _ in range(n):
+    next(gen)
+  us = time.ticks_diff(time.ticks_us(), start)
+  alloc = gc.mem_alloc() - alloc
+  gc.enable()
+  print("%-12s %6d frames/s %6.1f bytes/frame" % (name, n * 1000000 // us, alloc / n))
+
+table = frames.load('/nutki2020.frames')
+bench("frame table", frames.play(table))
+bench("computed", nutki2020.on_start(None, None))
@@ -0,0 +1,40 @@
+# Runs on the hub: measures how many LWP notifications per second LWPDevice.recv handles, and how much
+# memory each one allocates, without a BLE connection.
+import gc
+import time
+import lwp
+
+N = 2000
+
+class FakeConnection:
+  def callback(self, cb):
+    pass
+  def subscribe(self):
+    pass
+  def send(self, data):
+    pass
+  def disconnect(self, idx):
+    pass
+
+def bench(device, name, data, n = N):
+  gc.collect()
+  gc.disable()
+  alloc = gc.mem_alloc()
+  start = time.ticks_us()
+  for _ in range(n):
+    device.recv(data)
+  us = time.ticks_diff(time.ticks_us(), start)
+  alloc = gc.mem_alloc() - alloc
+  gc.enable()
+  print("%-16s %7d msg/s %6.1f bytes/msg" % (name, n * 1000000 // us, alloc / n))
+
+device = lwp.LWPDevice(FakeConnection(), lwp.HubType.POWERED_UP_REMOTE_ID, 0)
+device.flush()
+device.on_value(0x3c, lambda p: None)
+bench(device, "value (1 byte)", bytes([5, 0, 0x45, 0x00, 0x01]))
+bench(device, "value (4 bytes)", bytes([8, 0, 0x45, 0x3c, 0x10, 0x20, 0x30, 0x40]))
+bench(device, "feedback", bytes([5, 0, 0x82, 0x34, 0x0a]))
+bench(device, "hub property", bytes([6, 0, 0x01, 0x02, 0x06, 0x00]))
+lwp.DEBUG = True
+bench(device, "value (debug)", bytes([5, 0, 0x45, 0x00, 0x01]), 100)
+lwp.DEBUG = False
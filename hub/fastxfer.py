@@ -0,0 +1,77 @@
+# Receives files over the REPL connection as length prefixed binary chunks instead of base64 in REPL commands.
+# Copy it to the hub once (./cp.py hub/fastxfer.py); cp.py and `spikejsonrpc.py upload --fast` use it when
+# it is present.
+#
+# receive(path) answers 'R' when ready, then reads chunks of <length: 2 bytes LE><data><CRC-32: 4 bytes LE>
+# and answers each with 'K' when written or 'E' on a CRC mismatch (the chunk is sent again). A chunk of length
+# 0 ends the transfer, a length of 0xffff aborts it. Ctrl-C is disabled while receiving, as the data may
+# contain it; instead the transfer is abandoned when no byte arrives for `timeout` ms, so a host that went
+# away or a lost byte cannot leave the hub reading later commands as chunk data.
+import usys
+import uos
+import uselect
+import ubinascii
+import micropython
+
+ABORT = 0xffff
+
+def receive(path, timeout=2000):
+  inp = usys.stdin.buffer
+  out = usys.stdout
+  poll = uselect.poll()
+  poll.register(inp, uselect.POLLIN)
+
+  def read(n):
+    # a byte at a time, as only the first byte of a read is known to be there
+    b = bytearray(n)
+    for i in range(n):
+      if not poll.poll(timeout):
+        raise OSError('fastxfer: no data for %d ms' % timeout)
+      b[i] = inp.read(1)[0]
+    return b
+
+  tmp = path + '.tmp'
+  n = 0
+  crc = 0
+  micropython.kbd_intr(-1)
+  try:
+    with open(tmp, 'wb') as f:
+      out.write('R')
+      while True:
+        h = read(2)
+        size = h[0] | h[1] << 8
+        if size == 0:
+          break
+        if size == ABORT:
+          raise OSError('fastxfer: aborted by the host')
+        data = read(size)
+        c = read(4)
+        if ubinascii.crc32(data) & 0xffffffff != c[0] | c[1] << 8 | c[2] << 16 | c[3] << 24:
+          out.write('E')
+          continue
+        f.write(data)
+        n += size
+        crc = ubinascii.crc32(data, crc)
+        out.write('K')
+  except Exception:
+    uos.remove(tmp)
+    raise
+  finally:
+    micropython.kbd_intr(3)
+  try:
+    uos.remove(path)
+  except OSError:
+    pass
+  uos.rename(tmp, path)
+  print(n, crc & 0xffffffff)
+
+def update_slot(slot, size, modified, name=None):
+  # records the new size, modification time and (if given) name of a program rewritten in place
+  with open('/projects/.slots') as f:
+    slots = eval(f.read())
+  slots[slot]['size'] = size
+  slots[slot]['modified'] = modified
+  if name is not None:
+    slots[slot]['name'] = name
+  with open('/projects/.slots', 'w') as f:
+    f.write(repr(slots))
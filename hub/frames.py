@@ -0,0 +1,74 @@
+# Plays display animations precomputed on the host by pack_frames.py, without allocating memory per frame.
+# Copy it to the hub once (./cp.py hub/frames.py) together with the frame tables.
+#
+# A frame table is MAGIC, <frame interval in ms: 2 bytes LE>, <frame count: 4 bytes LE>, followed by every
+# frame as <number of changed pixels: 1 byte> and one byte per changed pixel: (y * 5 + x) * 10 + brightness.
+# The first frame is relative to a blank display.
+import hub
+import time
+import uos
+
+MAGIC = b'SPKF'
+HEADER = 10
+
+class Stats:
+  # frame rate of the last play(): frames shown, total time and the longest time between two frames
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.frames = 0
+    self.us = 0
+    self.max_us = 0
+
+  def fps(self):
+    return self.frames * 1000000 // self.us if self.us else 0
+
+def load(path):
+  # reads a frame table into a single buffer
+  data = bytearray(uos.stat(path)[6])
+  with open(path, 'rb') as f:
+    f.readinto(data)
+  if data[:4] != MAGIC:
+    raise ValueError('not a frame table: ' + path)
+  return data
+
+def play(data, stats=None, loops=1):
+  # Generator yielding once per frame with the frame interval, for the on_start coroutine of a
+  # VirtualMachine program:
+  #   for delay in frames.play(table):
+  #     yield delay
+  pixel = hub.display.pixel
+  interval = data[4] | data[5] << 8
+  count = data[6] | data[7] << 8 | data[8] << 16 | data[9] << 24
+  if stats:
+    stats.reset()
+  last = time.ticks_us()
+  for _ in range(loops):
+    hub.display.clear()
+    i = HEADER
+    for _ in range(count):
+      end = i + 1 + data[i]
+      i += 1
+      while i < end:
+        v = data[i]
+        p = v // 10
+        pixel(p % 5, p // 5, v - p * 10)
+        i += 1
+      if stats:
+        now = time.ticks_us()
+        d = time.ticks_diff(now, last)
+        last = now
+        stats.frames += 1
+        stats.us += d
+        if d > stats.max_us:
+          stats.max_us = d
+      yield interval
+
+def player(data, stats=None, loops=1):
+  # returns an on_start handler playing the table, for VirtualMachine.register_on_start
+  async def on_start(vm, stack):
+    for delay in play(data, stats, loops):
+      yield delay
+    hub.display.clear()
+  return on_start
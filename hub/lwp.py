@@ -9,12 +9,10 @@ class HubType:
   POWERED_UP_REMOTE_ID = 66
   CONTROL_PLUS_LARGE_HUB_ID = 128
 
-_connected_idx = None
-def _connect_callback(idx):
-  global _connected_idx
-  print("Connected: %d" % idx)
-  _connected_idx = idx
-hub.ble.callback(_connect_callback)
+LWP_SERVICE_ID = '00001623-1212-EFDE-1623-785FEABCD123'
+
+# print every message received (allocates, so it slows down message handling considerably)
+DEBUG = False
 
 def _hexlify(bytes):
   return binascii.hexlify(bytes, ' ').decode()
@@ -49,11 +47,42 @@ class LWPButton:
 class LWPObject:
   pass
 
+# Output commands are sent with command feedback requested. A port takes the next command once the device
+# reports (0x82, or 0x47 for a mode setup) that its buffer is empty; until then commands wait in the port
+# queue, where a newer command with the same key supersedes (removes) a queued one. The notification callback
+# only marks the port ready; queued commands are sent from sendPort() and flush() on the main side, so the
+# queues are never changed from the callback and it does not block on sending.
+FEEDBACK_TIMEOUT_MS = 200
+SEND_INTERVAL_MS = 20
+
+# State of a device port: the output command queue and the last reported value, kept in a preallocated
+# buffer (value[:length], overwritten by the next report).
+class LWPPort:
+  def __init__(self, port):
+    self.port = port
+    self.busy = False
+    self.sent_ms = 0
+    self.queue = []
+    self.value = bytearray(8)
+    self.length = 0
+    self.callback = None
+
+  def int_value(self, signed = True):
+    # the value as a little endian integer
+    v = 0
+    for i in range(self.length - 1, -1, -1):
+      v = (v << 8) | self.value[i]
+    if signed and self.length and self.value[self.length - 1] & 0x80:
+      v -= 1 << (8 * self.length)
+    return v
+
 class LWPDevice:
   def __init__(self, conn, model_id, idx):
     self.conn = conn
     self.idx = idx
     self.model_id = model_id
+    self.ports = {}
+    self._sent_ms = time.ticks_add(time.ticks_ms(), -SEND_INTERVAL_MS)
     self.conn.callback(self.recv)
     self.conn.subscribe()
     self.button = LWPObject()
@@ -70,6 +99,8 @@ class LWPDevice:
       self.button.B.red = LWPButton()
       self.button.B.minus = LWPButton()
       self.ledPort = 0x34
+      self.on_value(0, self._remote_buttons)
+      self.on_value(1, self._remote_buttons)
       self.portMode(0, 3)
       self.portMode(1, 3)
     else:
@@ -81,54 +112,150 @@ class LWPDevice:
     self.conn.disconnect(self.idx)
 
   def recv(self, data):
-    msg_type = data[2]
-    if msg_type == 0x82: # command feedback
-      print("cmd output feedback %d: port %02x status %02x" % (self.idx, data[3], data[4]))
-    elif msg_type == 0x05: # error
-      print("error %d: cmd %02x code %02x" % (self.idx, data[3], data[4]))
-    elif msg_type == 0x45: # port value (single)
-      port = data[3]
-      print("port value %d: port %02x" % (self.idx, port), _hexlify(data[4:]))
-      if self.model_id == HubType.POWERED_UP_REMOTE_ID and port < 2:
-        b = self.button.A if port == 0 else self.button.B
-        b.plus._change((data[4] >> 0) & 1)
-        b.red._change((data[4] >> 1) & 1)
-        b.minus._change((data[4] >> 2) & 1)
-    elif msg_type == 0x47: # port input format (single)
+    # called for every notification, so the handlers avoid allocating unless DEBUG is set
+    handler = _HANDLERS[data[2]]
+    if handler:
+      handler(self, data)
+    elif DEBUG:
+      print("recv data %02x: " % data[2], self.idx, _hexlify(data[3:]))
+
+  def _port(self, port):
+    p = self.ports.get(port)
+    if p is None:
+      p = self.ports[port] = LWPPort(port)
+    return p
+
+  def on_value(self, port, cb):
+    # cb(p) is called with the LWPPort whenever the device reports a new value for the port
+    self._port(port).callback = cb
+
+  def _recv_feedback(self, data): # command feedback, one or more (port, status) pairs
+    for i in range(3, len(data) - 1, 2):
+      if DEBUG:
+        print("cmd output feedback %d: port %02x status %02x" % (self.idx, data[i], data[i + 1]))
+      if data[i + 1] & 0x0f: # buffer empty, completed, discarded or idle
+        self._port_done(data[i])
+
+  def _recv_error(self, data):
+    print("error %d: cmd %02x code %02x" % (self.idx, data[3], data[4]))
+
+  def _recv_value(self, data): # port value (single)
+    p = self._port(data[3])
+    n = len(data) - 4
+    if n > len(p.value):
+      n = len(p.value)
+    v = p.value
+    for i in range(n):
+      v[i] = data[4 + i]
+    p.length = n
+    if DEBUG:
+      print("port value %d: port %02x" % (self.idx, data[3]), _hexlify(data[4:]))
+    if p.callback:
+      p.callback(p)
+
+  def _recv_format(self, data): # port input format (single)
+    if DEBUG:
       interval = int.from_bytes(data[5:8], 'little', False)
       print("port mode %d: port %02x mode %02x notify %02x interval %d" % (self.idx, data[3], data[4], data[9], interval))
-    elif msg_type == 0x01: # hub property update
+    self._port_done(data[3])
+
+  def _recv_prop(self, data): # hub property update
+    if DEBUG:
       print("hub action %d: prop %02x value" % (self.idx, data[3]), _hexlify(data[5:]))
-      if data[3] == 2:
-        self.button.green._change(data[5])
-    elif msg_type == 0x02: # hub action
+    if data[3] == 2:
+      self.button.green._change(data[5])
+
+  def _recv_action(self, data): # hub action
+    if DEBUG:
       print("hub action %d: %02x" % (self.idx, data[3]))
-    elif msg_type == 0x04: # port event
-      port = data[3]
-      event = data[4]
-      if event == 0x00: # detach
-        print("port detached %d: %02x" % (self.idx, port))
-      elif event == 0x01: # attach
-        id = int.from_bytes(data[5:6], 'little', False)
-        print("port attached %d: port %02x type %04d" % (self.idx, port, id))
-      elif event == 0x02: # attach virtual
-        id = int.from_bytes(data[5:6], 'little', False)
-        print("port attached virtual %d: port %02x type %04x %02x + %02x" % (self.idx, port, id, data[7], data[8]))
-    else:
-      print("recv data %02x: " % data[2], self.idx, _hexlify(data[3:]))
+
+  def _recv_event(self, data): # port event
+    port = data[3]
+    event = data[4]
+    if event != 0x00:
+      self._port(port)
+    if not DEBUG:
+      return
+    if event == 0x00: # detach
+      print("port detached %d: %02x" % (self.idx, port))
+    elif event == 0x01: # attach
+      id = int.from_bytes(data[5:6], 'little', False)
+      print("port attached %d: port %02x type %04d" % (self.idx, port, id))
+    elif event == 0x02: # attach virtual
+      id = int.from_bytes(data[5:6], 'little', False)
+      print("port attached virtual %d: port %02x type %04x %02x + %02x" % (self.idx, port, id, data[7], data[8]))
+
+  def _remote_buttons(self, p):
+    b = self.button.A if p.port == 0 else self.button.B
+    b.plus._change((p.value[0] >> 0) & 1)
+    b.red._change((p.value[0] >> 1) & 1)
+    b.minus._change((p.value[0] >> 2) & 1)
 
   def send(self, data):
+    wait = SEND_INTERVAL_MS - time.ticks_diff(time.ticks_ms(), self._sent_ms)
+    if wait > 0:
+      time.sleep_ms(wait)
     self.conn.send((len(data)+2).to_bytes(2, 'little') + data)
-    time.sleep(.2)
+    self._sent_ms = time.ticks_ms()
+
+  def sendPort(self, port, data, key):
+    # sends now if the port is ready, otherwise queues the command; also sends the next queued command of
+    # the other ports that became ready
+    p = self._port(port)
+    for q in self.ports.values():
+      if q is not p:
+        self._port_next(q)
+    self._port_next(p)
+    if not p.busy and not p.queue:
+      self._port_send(p, data)
+      return
+    for i in range(len(p.queue)):
+      if p.queue[i][0] == key:
+        del p.queue[i]
+        break
+    p.queue.append((key, data))
+    self._port_next(p)
+
+  def _port_send(self, p, data):
+    p.busy = True
+    p.sent_ms = time.ticks_ms()
+    self.send(data)
+
+  def _port_done(self, port):
+    # called from the notification callback
+    p = self.ports.get(port)
+    if p is not None:
+      p.busy = False
+
+  def _port_next(self, p):
+    # sends the next queued command if the port is ready; a port without feedback is released after
+    # FEEDBACK_TIMEOUT_MS
+    if p.busy and time.ticks_diff(time.ticks_ms(), p.sent_ms) >= FEEDBACK_TIMEOUT_MS:
+      p.busy = False
+    if not p.busy and p.queue:
+      self._port_send(p, p.queue.pop(0)[1])
+
+  def flush(self, timeout_ms = 2000):
+    # waits until all queued port commands are sent
+    start = time.ticks_ms()
+    while time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+      pending = False
+      for p in self.ports.values():
+        self._port_next(p)
+        pending = pending or bool(p.queue)
+      if not pending:
+        return True
+      time.sleep_ms(5)
+    return False
 
   def writePort(self, port, mode, data):
-    self.send(bytes([0x81, port, 0x11, 0x51, mode]) + data)
+    self.sendPort(port, bytes([0x81, port, 0x11, 0x51, mode]) + data, (0x81, mode))
 
   def writePort1(self, port, mode, b):
     self.writePort(port, mode, bytes([b & 255]))
 
   def portMode(self, port, mode, notify = 1):
-    self.send(bytes([0x41, port, mode, 1, 0, 0, 0, notify]))
+    self.sendPort(port, bytes([0x41, port, mode, 1, 0, 0, 0, notify]), (0x41,))
 
   def setHubProp(self, prop, data):
     self.send(bytes([0x01, prop, 0x01]) + data)
@@ -150,26 +277,107 @@ class LWPDevice:
       self.portMode(self.ledPort, 1, 0)
       self.writePort(self.ledPort, 1, bytes(args))
 
-def connect(timeout = 15):
-  global _connected_idx
-  hub.ble.scan(timeout)
-  for _ in range(timeout):
-    for i, a in enumerate(hub.ble.scan_result()):
-      if a['service_id'] == '00001623-1212-EFDE-1623-785FEABCD123':
-        hub_model_id = a['man_data'][1] if len(a['man_data']) > 1 else None
-        print("Connecting to hub model %d" % hub_model_id)
-        _connected_idx = None
-        conn = hub.ble.connect(i)
-        for _ in range(30):
-          if _connected_idx != None:
-            print('waited: %d' % _)
-            break
-          time.sleep(.1)
-        if conn and _connected_idx != None:
-          print("Connected")
-          time.sleep(1)
-          return LWPDevice(conn, hub_model_id, _connected_idx)
+# message type -> handler(device, data)
+_HANDLERS = [None] * 256
+_HANDLERS[0x82] = LWPDevice._recv_feedback
+_HANDLERS[0x05] = LWPDevice._recv_error
+_HANDLERS[0x45] = LWPDevice._recv_value
+_HANDLERS[0x47] = LWPDevice._recv_format
+_HANDLERS[0x01] = LWPDevice._recv_prop
+_HANDLERS[0x02] = LWPDevice._recv_action
+_HANDLERS[0x04] = LWPDevice._recv_event
+
+# Connects to LWP devices, reusing the result of the last scan while it is younger than scan_max_age_ms.
+# hub.ble reports a new connection only by its index, so connections are made one at a time and each one is
+# matched to the next index reported after its connect call.
+class LWPManager:
+  def __init__(self, scan_max_age_ms = 60000):
+    self.scan_max_age_ms = scan_max_age_ms
+    self.scan_ms = None
+    self.devices = {}
+    # scan result index of each connected device, and connection indices not claimed yet
+    self._adverts = {}
+    self._new_idx = []
+    hub.ble.callback(self._connect_callback)
+
+  def _connect_callback(self, idx):
+    if DEBUG:
+      print("Connected: %d" % idx)
+    self._new_idx.append(idx)
+
+  @staticmethod
+  def model(a):
+    return a['man_data'][1] if len(a['man_data']) > 1 else None
+
+  def _matches(self, a, hub_type, address):
+    if a['service_id'] != LWP_SERVICE_ID:
+      return False
+    if hub_type is not None and LWPManager.model(a) != hub_type:
+      return False
+    return address is None or a.get('address') == address
+
+  def find(self, hub_type = None, address = None, count = 1, timeout = 15):
+    # returns up to count scan result indices of devices not connected yet, scanning only if the cached
+    # result does not have enough of them
+    in_use = set(self._adverts.values())
+    def found():
+      return [i for i, a in enumerate(hub.ble.scan_result())
+              if i not in in_use and self._matches(a, hub_type, address)][:count]
+    if self.scan_ms is not None and time.ticks_diff(time.ticks_ms(), self.scan_ms) < self.scan_max_age_ms:
+      r = found()
+      if len(r) >= count:
+        return r
+    # a new scan renumbers the results, connected devices keep their connection (and stop advertising)
+    self._adverts = {}
+    in_use = set()
+    hub.ble.scan(timeout)
+    self.scan_ms = time.ticks_ms()
+    r = []
+    for _ in range(timeout):
+      r = found()
+      if len(r) >= count:
+        break
+      time.sleep(1)
+    return r
+
+  def connect(self, hub_type = None, address = None, count = 1, timeout = 15):
+    # connects to up to count devices matching hub_type and address, returns the list of LWPDevices
+    devices = []
+    for i in self.find(hub_type, address, count, timeout):
+      a = hub.ble.scan_result()[i]
+      model_id = LWPManager.model(a)
+      print("Connecting to hub model %d" % model_id)
+      self._new_idx.clear()
+      conn = hub.ble.connect(i)
+      for _ in range(30):
+        if self._new_idx:
+          break
+        time.sleep(.1)
+      if not conn or not self._new_idx:
         print('Connection timed out')
-        return None
-    time.sleep(1)
-  return None
+        continue
+      idx = self._new_idx.pop(0)
+      print("Connected")
+      time.sleep(1)
+      device = LWPDevice(conn, model_id, idx)
+      self.devices[idx] = device
+      self._adverts[idx] = i
+      devices.append(device)
+    return devices
+
+  def disconnect(self, device):
+    device.disconnect()
+    self.devices.pop(device.idx, None)
+    self._adverts.pop(device.idx, None)
+
+_manager = None
+
+def manager():
+  global _manager
+  if _manager is None:
+    _manager = LWPManager()
+  return _manager
+
+def connect(timeout = 15, hub_type = None, address = None):
+  devices = manager().connect(hub_type, address, 1, timeout)
+  return devices[0] if devices else None
@@ -0,0 +1,19 @@
+# hub/nutki2020.py played from a frame table, see animations/nutki2020.py. Needs hub/frames.py and
+# nutki2020.frames copied to the hub with cp.py.
+import hub
+import frames
+from runtime import VirtualMachine
+
+table = frames.load('/nutki2020.frames')
+stats = frames.Stats()
+
+async def on_start(vm, stack):
+  for delay in frames.play(table, stats):
+    yield delay
+  hub.display.clear()
+  print('%d frames/s, longest frame %d ms' % (stats.fps(), stats.max_us // 1000))
+
+def setup(rpc, system):
+  vm = VirtualMachine(rpc, system, "Nutki2020")
+  vm.register_on_start("on_start", on_start)
+  return vm
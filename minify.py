@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Makes programs smaller before they are sent to the hub: comments, docstrings, blank lines and needless
+# whitespace are removed and, for files copied with cp.py, the source can be precompiled to .mpy with
+# mpy-cross. Results are kept in a cache keyed by the hash of their input, so unchanged files cost nothing.
+import io
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import tokenize
+import argparse
+import subprocess
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'spike-tools')
+# part of the cache key, to be increased when the output of minify() changes
+VERSION = 1
+# .mpy format version the hub's MicroPython (1.12 in Spike Prime firmware) imports; mpy-cross from MicroPython
+# 1.19 and later writes version 6
+MPY_VERSION = 5
+
+FSTRING_START = getattr(tokenize, 'FSTRING_START', None)
+FSTRING_END = getattr(tokenize, 'FSTRING_END', None)
+
+
+def word_char(c):
+    return c.isalnum() or c == '_'
+
+
+def logical_lines(source):
+    # yields (indentation level, [(token type, text)]) for every statement line of the source
+    lines = source.decode('utf-8').splitlines(keepends=True)
+    depth = 0
+    line = []
+    fstring = None
+    for tok in tokenize.tokenize(io.BytesIO(source).readline):
+        if fstring is not None:
+            # f-strings (split into several tokens since Python 3.12) are copied from the source
+            if tok.type == FSTRING_START:
+                fstring[1] += 1
+            elif tok.type == FSTRING_END:
+                fstring[1] -= 1
+                if fstring[1] == 0:
+                    (row, col), (end_row, end_col) = fstring[0], tok.end
+                    text = ''.join(lines[row - 1:end_row])
+                    line.append((tokenize.STRING, text[col:len(text) - len(lines[end_row - 1]) + end_col]))
+                    fstring = None
+        elif tok.type == FSTRING_START:
+            fstring = [tok.start, 1]
+        elif tok.type == tokenize.INDENT:
+            depth += 1
+        elif tok.type == tokenize.DEDENT:
+            depth -= 1
+        elif tok.type == tokenize.NEWLINE:
+            yield depth, line
+            line = []
+        elif tok.type not in (tokenize.COMMENT, tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER):
+            line.append((tok.type, tok.string))
+
+
+def join(tokens):
+    out = []
+    last = None
+    for kind, text in tokens:
+        if out:
+            prev = out[-1]
+            if (word_char(prev[-1]) and (word_char(text[0]) or text[0] in '\'"')) or \
+                    (last == tokenize.NUMBER and text[0] == '.'):
+                out.append(' ')
+        out.append(text)
+        last = kind
+    return ''.join(out)
+
+
+def minify(source):
+    # Returns the minified source (bytes), or source itself if the result does not compile.
+    lines = [(depth, tokens) for depth, tokens in logical_lines(source)
+             if any(kind != tokenize.STRING for kind, _ in tokens)]
+    out = []
+    for i, (depth, tokens) in enumerate(lines):
+        out.append(' ' * depth + join(tokens) + '\n')
+        if tokens[-1] == (tokenize.OP, ':') and (i + 1 == len(lines) or lines[i + 1][0] <= depth):
+            # the block only held a docstring
+            out.append(' ' * (depth + 1) + 'pass\n')
+    result = ''.join(out).encode('utf-8')
+    try:
+        compile(result, '<minify>', 'exec')
+    except SyntaxError:
+        return source
+    return result
+
+
+def mpy_cross_version(mpy_cross='mpy-cross'):
+    if shutil.which(mpy_cross) is None:
+        return None
+    return subprocess.run([mpy_cross, '--version'], capture_output=True, text=True).stdout.strip()
+
+
+def compile_mpy(source, name, mpy_cross='mpy-cross'):
+    with tempfile.TemporaryDirectory() as tmp:
+        py = os.path.join(tmp, os.path.basename(name))
+        with open(py, 'wb') as f:
+            f.write(source)
+        mpy = os.path.splitext(py)[0] + '.mpy'
+        p = subprocess.run([mpy_cross, '-s', os.path.basename(name), '-o', mpy, py], capture_output=True, text=True)
+        if p.returncode:
+            raise RuntimeError('mpy-cross failed: %s' % p.stderr.strip())
+        with open(mpy, 'rb') as f:
+            return f.read()
+
+
+def cached(key, make, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, hashlib.sha256(key).hexdigest())
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        pass
+    data = make()
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return data
+
+
+def prepare(source, name, mpy=False, mpy_cross='mpy-cross', cache_dir=CACHE_DIR, mpy_version=MPY_VERSION):
+    # Returns (data, extension) for the source of file name: minified, and compiled to .mpy if mpy is set,
+    # mpy-cross is available and writes the .mpy format version the hub imports.
+    data = cached(b'minify %d\0' % VERSION + source, lambda: minify(source), cache_dir)
+    version = mpy_cross_version(mpy_cross) if mpy else None
+    if version is None:
+        return data, '.py'
+    key = b'mpy %s %s\0' % (version.encode('utf-8'), os.path.basename(name).encode('utf-8')) + data
+    compiled = cached(key, lambda: compile_mpy(data, name, mpy_cross), cache_dir)
+    if compiled[:1] != b'M' or len(compiled) < 2 or compiled[1] != mpy_version:
+        print('%s writes .mpy version %s, the hub needs %d; sending %s as .py' % (
+            mpy_cross, compiled[1] if compiled[:1] == b'M' and len(compiled) > 1 else 'unknown',
+            mpy_version, name), file=sys.stderr)
+        return data, '.py'
+    return compiled, '.mpy'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Minifies a MicroPython program')
+    parser.add_argument('file', help='program source')
+    parser.add_argument('-m', '--mpy', action='store_true', help='also compile to .mpy when mpy-cross is available')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as f:
+        source = f.read()
+    data, ext = prepare(source, args.file, args.mpy)
+    print('%s: %d -> %d bytes (%s)' % (args.file, len(source), len(data), ext), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(data)
+    else:
+        sys.stdout.buffer.write(data)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Packs display animations into frame tables played on the hub by hub/frames.py. Only the pixels that change
+# from one frame to the next are stored, one byte each, so the hub does no work (and allocates nothing) beyond
+# setting them.
+#
+# The source is either a Python file defining frames(), a generator of frames, and optionally INTERVAL (ms
+# per frame), or a text file with one frame per line. A frame is a hub.Image string ('09090:99999:...') or a
+# sequence of 5 rows of 5 brightness values (0-9), frame[y][x].
+import os
+import sys
+import struct
+import argparse
+import importlib.util
+
+MAGIC = b'SPKF'
+HEADER = struct.Struct('<4sHI')
+
+
+def pixels(frame):
+    # returns the 25 brightness values of a frame, row by row
+    rows = frame.split(':') if isinstance(frame, str) else frame
+    values = [int(v) for row in rows for v in row]
+    if len(rows) != 5 or len(values) != 25 or not all(0 <= v <= 9 for v in values):
+        raise ValueError('invalid frame %r' % (frame,))
+    return values
+
+
+def pack(frames, interval=1):
+    # returns the frame table (bytes) for an iterable of frames
+    out = bytearray()
+    last = [0] * 25
+    count = 0
+    for frame in frames:
+        values = pixels(frame)
+        changed = [i * 10 + v for i, (v, old) in enumerate(zip(values, last)) if v != old]
+        out.append(len(changed))
+        out += bytes(changed)
+        last = values
+        count += 1
+    return HEADER.pack(MAGIC, interval, count) + out
+
+
+def read_source(path):
+    # returns (frames, interval or None) of a source file
+    if path.endswith('.py'):
+        spec = importlib.util.spec_from_file_location('animation', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.frames(), getattr(module, 'INTERVAL', None)
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()], None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Packs an animation into a frame table for hub/frames.py')
+    parser.add_argument('source', help='Python file defining frames(), or text file with one frame per line')
+    parser.add_argument('-i', '--interval', type=int, help='ms per frame (default: INTERVAL of the source or 1)')
+    parser.add_argument('-o', '--output', help='output file (default: source name with .frames extension)')
+    args = parser.parse_args()
+
+    frames, interval = read_source(args.source)
+    data = pack(frames, args.interval or interval or 1)
+    output = args.output or os.path.splitext(args.source)[0] + '.frames'
+    with open(output, 'wb') as f:
+        f.write(data)
+    _, interval, count = HEADER.unpack_from(data)
+    print('%s: %d frames, %d bytes, %d ms per frame' % (output, count, len(data), interval), file=sys.stderr)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Capture and replay of serial traffic. CaptureSerial wraps a serial port and records every read and write with
+# its time; ReplaySerial plays a recording back in place of the port, so RPC and cp.py can be run and profiled
+# against real hub traffic without a hub.
+#
+# A trace is MAGIC followed by records of <direction: 1 byte, b'r' or b'w'><nanoseconds since the start: 8 bytes>
+# <length: 4 bytes><data>, all little endian.
+import re
+import time
+import struct
+import logging
+import argparse
+
+MAGIC = b'SPKTRACE\x01'
+RECORD = struct.Struct('<cQI')
+# request ids in JSON RPC messages, remapped on replay
+ID = re.compile(rb'"i":\s*"([^"]*)"')
+
+
+def read_trace(path):
+    # returns the list of (direction, seconds, data)
+    records = []
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a serial trace' % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return records
+            direction, ns, length = RECORD.unpack(header)
+            records.append((direction, ns / 1e9, f.read(length)))
+
+
+class CaptureSerial:
+    def __init__(self, ser, path):
+        self.ser = ser
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = time.perf_counter_ns()
+
+    def record(self, direction, data):
+        if data:
+            self.file.write(RECORD.pack(direction, time.perf_counter_ns() - self.start, len(data)))
+            self.file.write(data)
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        self.record(b'r', data)
+        return data
+
+    def write(self, data):
+        self.record(b'w', bytes(data))
+        return self.ser.write(data)
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.ser.timeout = value
+
+    def close(self):
+        self.file.close()
+        self.ser.close()
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+# Plays back the reads of a trace. The data read after a write becomes available once the corresponding write
+# has been made, and (unless fast) as long after it as in the recording. Request ids of JSON RPC messages
+# written are mapped to the ones in the recording, and the recorded responses are given the live ids.
+class ReplaySerial:
+    def __init__(self, path, fast=False):
+        self.records = read_trace(path)
+        self.fast = fast
+        self.pos = 0
+        self.timeout = None
+        self.ids = {}
+        self.buf = b''
+        # the recording time that corresponds to the current time
+        self.offset = time.perf_counter() - (self.records[0][1] if self.records else 0)
+
+    def write(self, data):
+        data = bytes(data)
+        if self.pos < len(self.records) and self.records[self.pos][0] == b'w':
+            _, t, recorded = self.records[self.pos]
+            self.pos += 1
+            for live, old in zip(ID.findall(data), ID.findall(recorded)):
+                self.ids[old] = live
+            if data != recorded and not ID.search(data):
+                logging.debug('Replay diverges: wrote %r, recorded %r' % (data[:40], recorded[:40]))
+            self.offset = time.perf_counter() - t
+        else:
+            logging.debug('Replay diverges: unexpected write %r' % data[:40])
+        return len(data)
+
+    def available(self):
+        # moves the reads that are due into the buffer and returns the time until the next one (None if the
+        # next record is a write or the trace has ended)
+        while self.pos < len(self.records) and self.records[self.pos][0] == b'r':
+            _, t, data = self.records[self.pos]
+            wait = 0 if self.fast else t - (time.perf_counter() - self.offset)
+            if wait > 0:
+                return wait
+            self.buf += ID.sub(lambda m: b'"i": "%s"' % self.ids.get(m.group(1), m.group(1)), data)
+            self.pos += 1
+        return None
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        while len(self.buf) < size:
+            wait = self.available()
+            if len(self.buf) >= size:
+                break
+            if wait is None:
+                if not self.fast and deadline is not None:
+                    time.sleep(max(0, deadline - time.perf_counter()))
+                break
+            if deadline is not None and time.perf_counter() + wait > deadline:
+                time.sleep(max(0, deadline - time.perf_counter()))
+                self.available()
+                break
+            time.sleep(wait)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    @property
+    def in_waiting(self):
+        self.available()
+        return len(self.buf)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarizes a serial trace')
+    parser.add_argument('file', help='trace recorded with --capture')
+    parser.add_argument('-d', '--dump', action='store_true', help='print every record')
+    args = parser.parse_args()
+
+    records = read_trace(args.file)
+    for direction, t, data in records if args.dump else []:
+        print('%10.6f %s %5d %r' % (t, direction.decode(), len(data), data[:100]))
+    for direction, name in ((b'w', 'written'), (b'r', 'read')):
+        chunks = [data for d, _, data in records if d == direction]
+        print('%-8s %6d records %9d bytes' % (name, len(chunks), sum(map(len, chunks))))
+    print('duration %.3fs' % (records[-1][1] - records[0][1] if records else 0))
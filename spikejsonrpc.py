@@ -1,30 +1,282 @@
 #!/usr/bin/env python
-import serial
 import base64
+import io
 import os
 import sys
 import argparse
-from tqdm import tqdm
 import time
 import json
 import random
 import string
 import logging
+import hashlib
+import tempfile
+import threading
+import bisect
+import shlex
+from collections import OrderedDict
 from datetime import datetime
 
+# serial, tqdm, asyncio and numpy are imported where they are used, to keep the start up of short commands fast
+
+
+# Splits the incoming byte stream into \r terminated frames. Data is appended to one reusable buffer and
+# consumed by advancing a read offset; consumed bytes are only discarded once they make up most of the buffer,
+# so a burst of frames costs one copy per frame instead of a copy of the whole remaining buffer.
+class Framer:
+    def __init__(self, separator=b'\x0d', compact_size=4096):
+        self.separator = separator
+        self.compact_size = compact_size
+        self.buf = bytearray()
+        self.pos = 0
+        self.scan = 0
+
+    def __len__(self):
+        return len(self.buf) - self.pos
+
+    def __iter__(self):
+        buf, sep = self.buf, self.separator
+        while True:
+            end = buf.find(sep, self.scan)
+            if end < 0:
+                self.scan = len(buf)
+                return
+            frame = buf[self.pos:end]
+            self.pos = self.scan = end + 1
+            yield frame
+
+    def feed(self, data):
+        if self.pos == len(self.buf):
+            self.buf.clear()
+            self.pos = self.scan = 0
+        elif self.pos >= self.compact_size and self.pos * 2 >= len(self.buf):
+            del self.buf[:self.pos]
+            self.scan -= self.pos
+            self.pos = 0
+        self.buf += data
+
+    def next_frame(self):
+        end = self.buf.find(self.separator, self.scan)
+        if end < 0:
+            self.scan = len(self.buf)
+            return None
+        frame = self.buf[self.pos:end]
+        self.pos = self.scan = end + 1
+        return frame
+
+
+# Buffered sink for the output of a running program, optionally copied to a log file with timestamps.
+# Writes that block for longer than stall_time (a slow terminal or disk) are counted as stalls.
+class Console:
+    def __init__(self, out=None, log=None, timestamps=False, interval=0.1, stall_time=0.05):
+        self.out = out
+        self.log = log
+        self.timestamps = timestamps
+        self.interval = interval
+        self.stall_time = stall_time
+        self.buf = []
+        self.size = 0
+        self.line_start = True
+        self.last_flush = self.start = time.time()
+        self.stats = {'bytes': 0, 'lines': 0, 'stalls': 0, 'stall_seconds': 0}
+
+    def write(self, text):
+        self.buf.append(text)
+        self.size += len(text)
+        self.stats['bytes'] += len(text)
+        self.stats['lines'] += text.count('\n')
+        if self.log:
+            self.write_log(text)
+        if self.size >= 4096:
+            self.flush()
+
+    def write_log(self, text):
+        if self.timestamps:
+            stamp = datetime.now().strftime('%H:%M:%S.%f')[:-3] + ' '
+            lines = text.split('\n')
+            text = '\n'.join(stamp + line if (i or self.line_start) and line else line for i, line in enumerate(lines))
+            self.line_start = text.endswith('\n')
+        self.log.write(text)
+
+    def tick(self):
+        if self.buf and time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        start = time.time()
+        out = self.out or sys.stdout
+        out.write(''.join(self.buf))
+        out.flush()
+        if self.log:
+            self.log.flush()
+        self.buf.clear()
+        self.size = 0
+        self.last_flush = time.time()
+        if self.last_flush - start > self.stall_time:
+            self.stats['stalls'] += 1
+            self.stats['stall_seconds'] += self.last_flush - start
+
+    def report(self):
+        elapsed = time.time() - self.start
+        return "%d bytes, %d lines in %.1fs (%.0f B/s); %d stalls (%.2fs)" % (
+            self.stats['bytes'], self.stats['lines'], elapsed, self.stats['bytes'] / elapsed if elapsed else 0,
+            self.stats['stalls'], self.stats['stall_seconds'])
+
+
+# Per method counters of an RPC connection: calls, round trip latency histogram, bytes sent and received,
+# timeouts and discarded frames (responses nobody waits for any more and frames that are not JSON).
+# Notifications from the hub are counted under their method, unparsable frames under ''.
+class Stats:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf'))
+
+    def __init__(self):
+        self.methods = {}
+        # id: (method, send time) of the requests in flight, and the method of requests that timed out
+        self.inflight = {}
+        self.expired = {}
+
+    def method(self, name):
+        m = self.methods.get(name)
+        if m is None:
+            m = self.methods[name] = {'calls': 0, 'latency': [0] * len(Stats.BUCKETS), 'latency_sum': 0,
+                                      'sent_bytes': 0, 'received_bytes': 0, 'timeouts': 0, 'discarded': 0}
+        return m
+
+    def sent(self, id, name, size):
+        m = self.method(name)
+        m['calls'] += 1
+        m['sent_bytes'] += size
+        self.inflight[id] = (name, time.perf_counter())
+
+    def received(self, msg, size):
+        id = msg.get('i') if isinstance(msg, dict) else None
+        if isinstance(msg, dict) and 'm' in msg:
+            self.method(str(msg['m']))['received_bytes'] += size
+        elif id in self.inflight:
+            name, sent = self.inflight.pop(id)
+            m = self.method(name)
+            m['received_bytes'] += size
+            latency = time.perf_counter() - sent
+            m['latency'][bisect.bisect_left(Stats.BUCKETS, latency)] += 1
+            m['latency_sum'] += latency
+        else:
+            m = self.method(self.expired.pop(id, '') if id is not None else '')
+            m['received_bytes'] += size
+            m['discarded'] += 1
+
+    def cancel(self, id):
+        self.inflight.pop(id, None)
+
+    def timeout(self, id):
+        if id in self.inflight:
+            name = self.inflight.pop(id)[0]
+            self.method(name)['timeouts'] += 1
+            self.expired[id] = name
+
+    def json(self):
+        return json.dumps({name: dict(m, latency=dict(zip(map(str, Stats.BUCKETS), m['latency'])))
+                           for name, m in sorted(self.methods.items())}, indent=2)
+
+    def prometheus(self):
+        lines = []
+        for metric, key, kind in (('calls_total', 'calls', 'counter'), ('sent_bytes_total', 'sent_bytes', 'counter'),
+                                  ('received_bytes_total', 'received_bytes', 'counter'),
+                                  ('timeouts_total', 'timeouts', 'counter'),
+                                  ('discarded_frames_total', 'discarded', 'counter'),
+                                  ('latency_seconds', None, 'histogram')):
+            lines.append('# TYPE spike_rpc_%s %s' % (metric, kind))
+            for name, m in sorted(self.methods.items()):
+                label = 'method="%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+                if key:
+                    lines.append('spike_rpc_%s{%s} %d' % (metric, label, m[key]))
+                    continue
+                if not m['calls']:
+                    continue
+                count = 0
+                for le, n in zip(Stats.BUCKETS, m['latency']):
+                    count += n
+                    lines.append('spike_rpc_latency_seconds_bucket{%s,le="%s"} %d'
+                                 % (label, '+Inf' if le == float('inf') else le, count))
+                lines.append('spike_rpc_latency_seconds_sum{%s} %f' % (label, m['latency_sum']))
+                lines.append('spike_rpc_latency_seconds_count{%s} %d' % (label, count))
+        return '\n'.join(lines)
+
+
+# Smoothed round trip time and its mean deviation (as in TCP, RFC 6298), giving the time after which a
+# response is considered lost. Before the first sample the timeout is `initial`.
+class RTT:
+    def __init__(self, initial=1, min_timeout=0.05, max_timeout=10):
+        self.initial = initial
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self):
+        if self.srtt is None:
+            return self.initial
+        return min(max(self.srtt + 4 * self.rttvar, self.min_timeout), self.max_timeout)
+
+
+class RPCTimeoutError(ConnectionError):
+    pass
+
 
 class RPC:
     letters = string.ascii_letters + string.digits + '_'
+    # methods that can be sent again when their response is lost
+    IDEMPOTENT = {'get_firmware_info', 'get_storage_status', 'trigger_current_state', 'program_modechange',
+                  'program_terminate', 'scratch.display_image', 'scratch.display_set_pixel', 'scratch.display_clear'}
 
-    def __init__(self, tty='/dev/ttyACM0'):
-        for i in range(1, 6):
+    def __init__(self, tty='/dev/ttyACM0', retries=5, ser=None):
+        # ser replaces the serial port, e.g. with a serialtrace.ReplaySerial
+        self.ser = ser if ser is not None else RPC.open_serial(tty, retries)
+        self.opened = time.time()
+        # seconds the hub needs after the port is opened before it reports its storage status reliably; a
+        # replay played back as fast as possible has no hub to wait for
+        self.settle_time = 0 if getattr(ser, 'fast', False) else 1
+        self.framer = Framer()
+        # responses received for outstanding requests other than the one being waited for
+        self.pending = {}
+        self.subscribers = []
+        # optional callable checked while waiting for responses, waiting stops when it returns True
+        self.abort = None
+        # print acknowledgements not sent yet, and the Console receiving program output
+        self.acks = []
+        self.console = None
+        # a Stats instance to collect protocol statistics, None to disable them
+        self.stats = None
+        # RTT estimate per method and of the whole connection, the method and send time of the requests in
+        # flight and how often a request is sent (idempotent methods) or waited for again with twice the timeout
+        # before giving up
+        self.rtt = {}
+        self.link_rtt = RTT()
+        self.sent = {}
+        self.retries = 2
+
+    @staticmethod
+    def open_serial(tty, retries=5):
+        import serial
+        for i in range(1, retries + 1):
             try:
-                self.ser = serial.Serial(tty, 115200)
-                # self.ser = serial.Serial(tty, 9600)
-                break
-            except:
+                return serial.Serial(tty, 115200)
+                # return serial.Serial(tty, 9600)
+            except serial.SerialException as e:
+                if i == retries:
+                    raise ConnectionError(f'Cannot open {tty}: {e}')
                 print(f'Retrying ({i})...')
-        self.recv_buf = bytearray()
+
+    def subscribe(self, callback):
+        # callback(msg) receives the hub state frames (m == 0 sensors, motors and IMU, m == 2 battery)
+        self.subscribers.append(callback)
 
     @staticmethod
     def random_id(length=4):
@@ -34,86 +286,165 @@ class RPC:
         start_time = time.time()
         elapsed = 0
         while True:
-            pos = self.recv_buf.find(b'\x0d')
-            # if len(self.recv_buf) > 0:
-            #     logging.debug(f'XXX: {self.recv_buf}')
-            if pos >= 0:
-                result = self.recv_buf[:pos]
-                self.recv_buf = self.recv_buf[pos + 1:]
-                data = result.decode('utf-8')
-
-                idx = data.find('{')
-                if idx != -1:
-                    data = data[idx:]
-                try:
-                    res = json.loads(data)
+            frame = self.framer.next_frame()
+            if frame is not None:
+                res = RPC.parse_frame(frame, console_out)
+                if self.stats is not None:
+                    self.stats.received(res, len(frame) + 1)
+                if res is not None:
+                    if 'i' in res and res['i'] in self.pending and ('r' in res or 'e' in res):
+                        # response to a request in flight, kept until asked for
+                        self.pending[res['i']] = res
+                        if res['i'] in self.sent:
+                            name, sent = self.sent.pop(res['i'])
+                            rtt = time.perf_counter() - sent
+                            self.rtt.setdefault(name, RTT()).sample(rtt)
+                            self.link_rtt.sample(rtt)
                     self.process_json(res)
                     return res
-                except json.JSONDecodeError:
-                    if len(data):
-                        logging.debug("Cannot parse JSON: %s" % data)
-                        if console_out:
-                            print(data)
-                        pass
-                    pass
+                continue
+            # all complete frames are processed, acknowledge the prints among them in one write
+            self.flush_acks()
             c = self.ser.inWaiting()
             if c == 0 and elapsed >= timeout:
                 break
-            self.ser.timeout = timeout
+            self.ser.timeout = max(timeout - elapsed, 0)
             new_data = self.ser.read(c if c else 1)
             if len(new_data):
-                # print('aaa:', new_data)
-                self.recv_buf = self.recv_buf + new_data
-                pass
+                self.framer.feed(new_data)
 
             elapsed = time.time() - start_time
         return None
 
+    @staticmethod
+    def parse_frame(frame, console_out=False):
+        idx = frame.find(b'{')
+        if idx > 0:
+            frame = frame[idx:]
+        try:
+            return json.loads(frame)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            if len(frame):
+                data = frame.decode('utf-8', 'replace')
+                logging.debug("Cannot parse JSON: %s" % data)
+                if console_out:
+                    print(data)
+
     def send_message_0(self, msg):
         msg_string = json.dumps(msg)
         logging.debug('sending: %s' % msg_string)
-        # self.ser.write(msg_string.encode('utf-8')+b'\x0D')
-        # self.ser.flush()
-        self.ser.write(msg_string.encode('utf-8'))
-        self.ser.write(b'\x0D')
-        # self.ser.flush()
+        self.ser.write(self.take_acks() + msg_string.encode('utf-8') + b'\x0D')
+
+    def take_acks(self):
+        acks = b''.join(self.acks)
+        self.acks.clear()
+        return acks
 
-    def send_message(self, name, params={}, timeout=1):
+    def flush_acks(self):
+        if self.acks:
+            self.ser.write(self.take_acks())
+
+    def drain(self):
         while True:
             if not self.recv_message(timeout=0):
                 break
 
+    def send_request(self, name, params={}):
         id = RPC.random_id()
         msg = {'i': id, 'm': name, 'p': params}
+        self.pending[id] = None
+        if self.stats is not None:
+            self.stats.sent(id, name, len(json.dumps(msg)) + 1)
         self.send_message_0(msg)
+        self.sent[id] = (name, time.perf_counter())
+        return id
+
+    def rtt_estimate(self, name):
+        # the estimate of the method once it has been answered, the one of the connection before
+        estimate = self.rtt.get(name)
+        return estimate if estimate is not None else self.link_rtt
 
-        return self.recv_response(id, timeout=1)
+    def first_timeout(self, name):
+        # A method not answered yet may take much longer than the queries the connection estimate is learned
+        # from, so unless it can be repeated it is given at least the initial timeout. Before any response on
+        # the connection, the initial timeout is shared by all attempts of a repeatable request, so one that is
+        # never answered fails as fast as it did with a fixed timeout.
+        estimate = self.rtt.get(name)
+        if estimate is not None:
+            return estimate.timeout()
+        link = self.link_rtt
+        if name not in RPC.IDEMPOTENT:
+            return max(link.timeout(), link.initial)
+        if link.srtt is None:
+            return link.initial / (2 ** (self.retries + 1) - 1)
+        return link.timeout()
 
-    def recv_response(self, id, timeout=1, console_out=False):
+    def send_message(self, name, params={}, timeout=None):
+        # Waits for the response for the estimated round trip timeout (or `timeout`), doubling it on every
+        # retry. Idempotent requests are sent again with a new id and a response to any of the attempts is
+        # accepted; others are only waited for longer. Raises RPCTimeoutError when no response arrives.
+        self.drain()
+        timeout = timeout or self.first_timeout(name)
+        ids = []
+        for attempt in range(self.retries + 1):
+            if not ids or name in RPC.IDEMPOTENT:
+                ids.append(self.send_request(name, params))
+            m = self.wait_response(*ids, timeout=timeout, forget=False)
+            if m is not None:
+                self.forget(ids)
+                return RPC.result(m)
+            if self.abort and self.abort():
+                break
+            logging.debug(f'No response to {name} after {timeout:.3f}s, attempt {attempt + 1}')
+            timeout = min(timeout * 2, self.rtt_estimate(name).max_timeout)
+        self.forget(ids, timed_out=True)
+        raise RPCTimeoutError(f'No response to {name} after {len(ids)} request(s) and {attempt + 1} wait(s)')
+
+    @staticmethod
+    def result(m):
+        if 'e' in m:
+            error = json.loads(base64.b64decode(m['e']).decode('utf-8'))
+            raise ConnectionError(error)
+        return m['r']
+
+    def recv_response(self, id, timeout=None, console_out=False):
+        m = self.wait_response(id, timeout=timeout, console_out=console_out)
+        return RPC.result(m) if m is not None else None
+
+    def wait_response(self, *ids, timeout=None, console_out=False, forget=True):
+        # Returns the first response to one of ids, or None after timeout. Without a timeout, waits as long
+        # as send_message would for a request that cannot be repeated. With forget, the requests are given up
+        # on a timeout.
+        if timeout is None:
+            timeout = self.first_timeout(self.sent[ids[0]][0] if ids[0] in self.sent else None) \
+                * (2 ** (self.retries + 1) - 1)
         start_time = time.time()
         elapsed = 0
         while True:
-            if elapsed >= timeout:
-                logging.debug(f'Timeout while waiting for response for id: {id}')
+            for id in ids:
+                if self.pending.get(id) is not None:
+                    return self.pending.pop(id)
+            if elapsed >= timeout or (self.abort and self.abort()):
+                logging.debug(f'Timeout while waiting for response for id: {ids}')
+                if forget:
+                    self.forget(ids, timed_out=True)
                 return
-            m = self.recv_message(timeout=1, console_out=console_out)
-            if m is None:
-                continue
-            if 'i' in m and m['i'] == id:
-                logging.debug(f'getting: {m} for {id}')
-                if 'e' in m:
-                    error = json.loads(base64.b64decode(m['e']).decode('utf-8'))
-                    raise ConnectionError(error)
-                return m['r']
-            else:
-                # logging.debug(f'getting: {m}')
-                pass
-
-            # logging.debug(f'While waiting for response: {m}')
+            self.recv_message(timeout=timeout - elapsed, console_out=console_out)
             elapsed = time.time() - start_time
 
+    def forget(self, ids, timed_out=False):
+        for id in ids:
+            self.pending.pop(id, None)
+            self.sent.pop(id, None)
+            if self.stats is not None:
+                if timed_out:
+                    self.stats.timeout(id)
+                else:
+                    # earlier attempts of a request answered through another one
+                    self.stats.cancel(id)
+
     # Program Methods
-    def program_execute(self, n):
+    def program_execute(self, n, console=True):
         # self.get_firmware_info()
         # self.send_message('trigger_current_state')
         # time.sleep(0.1)
@@ -123,28 +454,142 @@ class RPC:
         res = self.send_message('program_execute', {'slotid': n})
         # time.sleep(0.5)
 
-        self.recv_response('', timeout=120, console_out=True)
+        if console:
+            self.run_console(console if isinstance(console, Console) else Console())
 
         return res
 
+    def run_console(self, console, timeout=120):
+        self.console = console
+        start_time = time.time()
+        try:
+            while time.time() - start_time < timeout and not (self.abort and self.abort()):
+                self.recv_message(timeout=console.interval, console_out=True)
+                console.tick()
+        finally:
+            self.flush_acks()
+            self.console = None
+            console.flush()
+
     def program_terminate(self):
         return self.send_message('program_terminate')
 
+    def close(self):
+        self.ser.close()
+
     def get_storage_information(self):
-        time.sleep(1)
+        # the hub does not report the storage status reliably right after the port is opened
+        time.sleep(max(0, self.opened + self.settle_time - time.time()))
         self.send_message('trigger_current_state')
-        return self.send_message('get_storage_status', timeout=0)
+        return self.send_message('get_storage_status')
 
-    def start_write_program(self, name, size, slot, created, modified):
+    def start_write_program(self, name, size, slot, created, modified, extra_meta={}):
         short_name = name.split(os.sep)
         meta = {'created': created, 'modified': modified, 'name': name, 'type': 'python',
-                'project_id': RPC.random_id(12)}
+                'project_id': RPC.random_id(12), **extra_meta}
         res = self.send_message('start_write_program', {'slotid': slot, 'size': size, 'meta': meta})
         return res
 
     def write_package(self, data, transferid):
-        return self.send_message('write_package',
-                                 {'data': str(base64.b64encode(data), 'utf-8'), 'transferid': transferid})
+        return self.send_message('write_package', RPC.package_params(data, transferid))
+
+    @staticmethod
+    def package_params(data, transferid):
+        return {'data': str(base64.b64encode(data), 'utf-8'), 'transferid': transferid}
+
+    def write_packages(self, data, transferid, blocksize, window=1, progress=None):
+        # Keeps up to `window` write_package requests in flight. Packages are sent in order and
+        # acknowledged in order; the hub appends them to the transfer as they arrive.
+        blocks = (data[i:i + blocksize] for i in range(0, len(data), blocksize))
+        if window <= 1:
+            for b in blocks:
+                self.write_package(b, transferid)
+                if progress:
+                    progress(len(b))
+            return
+        self.drain()
+        in_flight = OrderedDict()
+        while True:
+            for b in blocks:
+                in_flight[self.send_request('write_package', RPC.package_params(b, transferid))] = b
+                if len(in_flight) >= window:
+                    break
+            if not in_flight:
+                return
+            id, b = in_flight.popitem(last=False)
+            try:
+                m = self.wait_response(id)
+                if m is None:
+                    raise RPCTimeoutError(f'Timeout while waiting for write_package {id}')
+                RPC.result(m)
+            except ConnectionError:
+                self.forget(in_flight)
+                raise
+            if progress:
+                progress(len(b))
+
+    def write_program(self, data, slot, name, window=1, retries=2, progress=None, extra_meta={}):
+        # A failed package leaves the transfer in an unknown state, as packages carry no offset,
+        # so a retry restarts the whole transfer. A transfer that was not confirmed to start is not retried,
+        # the hub may still have opened it.
+        now = int(time.time() * 1000)
+        for attempt in range(retries + 1):
+            written = 0
+            start = None
+
+            def update(n):
+                nonlocal written
+                written += n
+                if progress:
+                    progress(n)
+            try:
+                start = self.start_write_program(name, len(data), slot, now, now, extra_meta)
+                self.write_packages(data, start['transferid'], start['blocksize'], window, update)
+                return
+            except ConnectionError as e:
+                if attempt == retries or (start is None and isinstance(e, RPCTimeoutError)):
+                    raise
+                logging.debug(f'Upload failed ({e}), retrying ({attempt + 1})...')
+                if progress:
+                    progress(-written)
+
+    def rewrite_program(self, data, slot, progress=None, name=None):
+        # Replaces the code of the program in an existing slot through the REPL, sending it as binary chunks to
+        # hub/fastxfer.py instead of base64 packages, and renames the slot to name if given. Returns False
+        # without changes if the slot is empty or fastxfer is not installed on the hub. The hub runtime is
+        # restarted afterwards, and this returns once it answers again.
+        from cp import Repl
+        meta = self.get_storage_information()['slots'].get(str(slot))
+        if meta is None:
+            return False
+        repl = Repl(self.ser)
+        repl.enter()
+        done = False
+        try:
+            if repl.has_fastxfer():
+                repl.put_fast(io.BytesIO(data), '/projects/%d/__init__.py' % meta['id'], progress=progress)
+                repl.exec_raw(b'fastxfer.update_slot(%d, %d, %d, %r)'
+                              % (slot, len(data), int(time.time() * 1000), name))
+                done = True
+        finally:
+            repl.close()
+            self.framer = Framer()
+            self.opened = time.time()
+            # round trip times of the old runtime say nothing about the restarting one
+            self.rtt = {}
+            self.link_rtt = RTT()
+        self.wait_ready()
+        return done
+
+    def wait_ready(self, timeout=10):
+        # polls the hub until its runtime answers, e.g. after a restart
+        start_time = time.time()
+        while True:
+            try:
+                return self.send_message('get_firmware_info')
+            except RPCTimeoutError:
+                if time.time() - start_time >= timeout:
+                    raise
 
     def move_project(self, from_slot, to_slot):
         return self.send_message('move_project', {'old_slotid': from_slot, 'new_slotid': to_slot})
@@ -168,6 +613,54 @@ class RPC:
     def display_text(self, text):
         return self.send_message('scratch.display_text', {'text': text})
 
+    @staticmethod
+    def display_updates(previous, image):
+        # The messages turning the display from previous into image: the changed pixels, or the whole image
+        # if that takes fewer bytes. Images are strings of rows of brightness digits separated by ':'.
+        pixels = image.replace(':', '')
+        if previous is None:
+            return [('scratch.display_image', {'image': image})]
+        changed = [('scratch.display_set_pixel', {'x': i % 5, 'y': i // 5, 'brightness': int(b)})
+                   for i, (a, b) in enumerate(zip(previous.replace(':', ''), pixels)) if a != b]
+        whole = [('scratch.display_image', {'image': image})]
+        return min(changed, whole, key=lambda messages: sum(RPC.message_size(*m) for m in messages))
+
+    @staticmethod
+    def message_size(name, params):
+        return len(json.dumps({'i': 'xxxx', 'm': name, 'p': params})) + 1
+
+    def display_play(self, frames, fps=10, window=8):
+        # Shows the frames at fps without waiting for each response; at most window requests are in flight.
+        # A frame more than one frame interval late is dropped (the next one is diffed against what is shown).
+        interval = 1 / fps
+        in_flight = []
+        shown = None
+        stats = {'frames': 0, 'dropped': 0, 'messages': 0, 'bytes': 0}
+        self.drain()
+        start = time.perf_counter()
+        for n, image in enumerate(frames):
+            due = start + n * interval
+            now = time.perf_counter()
+            if now > due + interval:
+                stats['dropped'] += 1
+                continue
+            while now < due:
+                self.recv_message(timeout=due - now)
+                now = time.perf_counter()
+            for name, params in RPC.display_updates(shown, image):
+                while len(in_flight) >= window:
+                    if self.wait_response(in_flight.pop(0)) is None:
+                        logging.debug('Timeout while waiting for display update')
+                in_flight.append(self.send_request(name, params))
+                stats['messages'] += 1
+                stats['bytes'] += RPC.message_size(name, params)
+            shown = image
+            stats['frames'] += 1
+        for id in in_flight:
+            self.wait_response(id)
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+
     # Hub Methods
     def get_firmware_info(self):
         return self.send_message('get_firmware_info')
@@ -175,6 +668,8 @@ class RPC:
     def process_json(self, res):
         if 'm' in res.keys():
             if res['m'] == 0 or res['m'] == 2:
+                for callback in self.subscribers:
+                    callback(res)
                 return
             # print('JSON:', res)
             if res['m'] == 'runtime_error' or res['m'] == 'user_program_error':
@@ -183,11 +678,13 @@ class RPC:
                 raise SystemExit
                 return
             if res['m'] == "userProgram.print":
-                data = res['p']['value']
-                id = res['i']
-                print(RPC.decode(data), end='')
-                msg = {'i': id, 'r': None}
-                self.send_message_0(msg)
+                # the hub waits for the acknowledgement before it continues, so it goes out before the
+                # output is written
+                self.acks.append(json.dumps({'i': res['i'], 'r': None}).encode('utf-8') + b'\x0D')
+                if self.console:
+                    self.console.write(RPC.decode(res['p']['value']))
+                else:
+                    print(RPC.decode(res['p']['value']), end='')
                 return
             logging.debug(res)
         elif 'e' in res.keys():
@@ -201,6 +698,369 @@ class RPC:
         return base64.b64decode(data).decode('utf-8')
 
 
+# asyncio client for the JSON RPC protocol. A single reader task parses incoming frames and resolves the
+# future of the matching request, so any number of coroutines can await calls concurrently. Blocking serial
+# reads run in the default executor.
+class AsyncRPC:
+
+    def __init__(self, tty='/dev/ttyACM0'):
+        import serial
+        self.ser = serial.Serial(tty, 115200, timeout=0.1)
+        self.framer = Framer()
+        self.futures = {}
+        self.reader = None
+        self.subscribers = []
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def start(self):
+        import asyncio
+        if self.reader is None:
+            self.reader = asyncio.get_running_loop().create_task(self.read_loop())
+
+    async def close(self):
+        import asyncio
+        if self.reader is not None:
+            self.reader.cancel()
+            try:
+                await self.reader
+            except asyncio.CancelledError:
+                pass
+            self.reader = None
+        self.ser.close()
+
+    def read(self):
+        return self.ser.read(self.ser.in_waiting or 1)
+
+    async def read_loop(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            new_data = await loop.run_in_executor(None, self.read)
+            if not new_data:
+                continue
+            self.framer.feed(new_data)
+            for frame in self.framer:
+                m = RPC.parse_frame(frame)
+                if m is not None:
+                    self.process_json(m)
+
+    def process_json(self, res):
+        if 'i' in res and ('r' in res or 'e' in res):
+            future = self.futures.pop(res['i'], None)
+            if future is None or future.done():
+                return
+            try:
+                future.set_result(RPC.result(res))
+            except ConnectionError as e:
+                future.set_exception(e)
+            return
+        if 'm' in res:
+            if res['m'] == 0 or res['m'] == 2:
+                for callback in self.subscribers:
+                    callback(res)
+                return
+            if res['m'] == 'runtime_error' or res['m'] == 'user_program_error':
+                print('Error: {}'.format(RPC.decode(res['p'][3])), file=sys.stderr)
+                return
+            if res['m'] == "userProgram.print":
+                print(RPC.decode(res['p']['value']), end='')
+                self.send_message_0({'i': res['i'], 'r': None})
+                return
+        logging.debug(res)
+
+    def send_message_0(self, msg):
+        msg_string = json.dumps(msg)
+        logging.debug('sending: %s' % msg_string)
+        self.ser.write(msg_string.encode('utf-8') + b'\x0D')
+
+    async def call(self, name, params={}, timeout=1):
+        import asyncio
+        self.start()
+        id = RPC.random_id()
+        while id in self.futures:
+            id = RPC.random_id()
+        future = asyncio.get_running_loop().create_future()
+        self.futures[id] = future
+        try:
+            self.send_message_0({'i': id, 'm': name, 'p': params})
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.futures.pop(id, None)
+
+
+LEGO_USB_VID = 0x0694
+
+
+def find_hubs():
+    from serial.tools import list_ports
+    return sorted(p.device for p in list_ports.comports() if p.vid == LEGO_USB_VID)
+
+
+def run_fleet(ports, action, workers=None):
+    # Runs action(rpc, pbar) on every hub concurrently, each with its own connection (or the daemon serving the
+    # hub) and progress bar. Returns a list of (port, error, seconds, result) in the order of ports.
+    from tqdm import tqdm
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(position, port):
+        start_time = time.time()
+        with tqdm(total=1, desc=port, position=position, leave=True) as pbar:
+            try:
+                rpc = DaemonClient.connect(port) or RPC(port, retries=1)
+                try:
+                    result = action(rpc, pbar)
+                finally:
+                    rpc.close()
+                return port, None, time.time() - start_time, result
+            except (Exception, SystemExit) as e:
+                # any failure, also an unexpected reply or a program error, only fails the row of its hub
+                return port, e, time.time() - start_time, None
+
+    with ThreadPoolExecutor(max_workers=workers or len(ports) or 1) as pool:
+        return list(pool.map(run, range(len(ports)), ports))
+
+
+# Remembers the content hash of uploaded programs by slot id and modification time, for hubs that do not keep
+# the hash sent in the program meta.
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def key(slot):
+        return '%s:%s' % (slot['id'], slot['modified'])
+
+    def get(self, slot):
+        return self.entries.get(Manifest.key(slot))
+
+    def set(self, slot, hash):
+        with self.lock:
+            self.entries[Manifest.key(slot)] = hash
+
+    def discard(self, slot):
+        with self.lock:
+            self.entries.pop(Manifest.key(slot), None)
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def sync_programs(rpc, programs, manifest, window=1, force=False, progress=None):
+    # programs maps slot numbers to file names; uploads only the files whose content differs from the
+    # program in the slot. Returns the list of (slot, uploaded) in the order of programs.
+    slots = rpc.get_storage_information()['slots']
+    results = []
+    uploaded = {}
+    for slot, file in programs.items():
+        with open(file, 'rb') as f:
+            data = f.read()
+        hash = content_hash(data)
+        current = slots.get(str(slot))
+        if not force and current and hash in (current.get('hash'), manifest.get(current)):
+            results.append((slot, False))
+            continue
+        rpc.write_program(data, slot, file, window=window, progress=progress, extra_meta={'hash': hash})
+        if current:
+            manifest.discard(current)
+        uploaded[slot] = hash
+        results.append((slot, True))
+    if uploaded:
+        slots = rpc.get_storage_information()['slots']
+        for slot, hash in uploaded.items():
+            if str(slot) in slots:
+                manifest.set(slots[str(slot)], hash)
+        manifest.save()
+    return results
+
+
+# Methods of RPC a daemon serves to its clients.
+DAEMON_METHODS = {'get_storage_information', 'get_firmware_info', 'program_execute', 'program_terminate',
+                  'move_project', 'remove_project', 'write_program', 'display_set_pixel', 'display_clear',
+                  'display_image', 'display_image_for', 'display_text', 'send_message', 'rewrite_program'}
+
+
+def daemon_socket(tty):
+    return os.path.join(tempfile.gettempdir(), 'spikejsonrpc-%d-%s.sock' % (os.getuid(), tty.strip('/').replace('/', '_')))
+
+
+def encode_value(value):
+    if isinstance(value, bytes):
+        return {'__bytes__': str(base64.b64encode(value), 'utf-8')}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+# Holds one open RPC connection and serves calls from DaemonClient over a Unix socket, one connection at a time.
+# The hub input is drained while idle.
+def serve_daemon(tty):
+    import socketserver
+    import contextlib
+    import select
+    rpc = RPC(tty)
+    path = daemon_socket(tty)
+
+    class Output:
+        # forwards console output of the call to the client as it is printed
+        def __init__(self, wfile):
+            self.wfile = wfile
+
+        def write(self, text):
+            if text:
+                self.wfile.write(json.dumps({'output': text}).encode('utf-8') + b'\n')
+            return len(text)
+
+        def flush(self):
+            self.wfile.flush()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            # clients do not send anything while waiting for a call, so a readable socket means they hung up
+            rpc.abort = lambda: bool(select.select([self.connection], [], [], 0)[0])
+            try:
+                for line in self.rfile:
+                    self.handle_request(json.loads(line))
+            except BrokenPipeError:
+                pass
+            finally:
+                rpc.abort = None
+
+        def handle_request(self, request):
+            if request['method'] == 'shutdown':
+                self.wfile.write(b'{"result": null}\n')
+                threading.Thread(target=server.shutdown).start()
+                return
+            try:
+                if request['method'] not in DAEMON_METHODS:
+                    raise AttributeError('unsupported method %s' % request['method'])
+                args = [decode_value(a) for a in request['args']]
+                with contextlib.redirect_stdout(Output(self.wfile)):
+                    result = getattr(rpc, request['method'])(*args, **request['kwargs'])
+                response = {'result': encode_value(result)}
+            except (Exception, SystemExit) as e:
+                response = {'error': str(e), 'type': type(e).__name__}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    class Server(socketserver.UnixStreamServer):
+        def service_actions(self):
+            rpc.drain()
+
+    if os.path.exists(path):
+        if DaemonClient.connect(tty):
+            raise ConnectionError('A daemon is already serving %s' % tty)
+        os.remove(path)
+    with Server(path, Handler) as server:
+        try:
+            server.serve_forever(poll_interval=0.2)
+        finally:
+            os.remove(path)
+            rpc.close()
+
+
+# Stands in for RPC when a daemon serves the hub.
+class DaemonClient:
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rwb')
+        # Console receiving the output forwarded by the daemon, None to print it
+        self.console = None
+
+    @staticmethod
+    def connect(tty):
+        import socket
+        path = daemon_socket(tty)
+        if not os.path.exists(path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            return None
+        return DaemonClient(sock)
+
+    def call(self, method, *args, **kwargs):
+        request = {'method': method, 'args': [encode_value(a) for a in args], 'kwargs': kwargs}
+        self.file.write(json.dumps(request).encode('utf-8') + b'\n')
+        self.file.flush()
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError('Daemon closed the connection')
+            response = json.loads(line)
+            if 'output' not in response:
+                break
+            if self.console:
+                self.console.write(response['output'])
+                self.console.tick()
+            else:
+                print(response['output'], end='', flush=True)
+        if 'error' in response:
+            if response['type'] == 'SystemExit':
+                raise SystemExit(1)
+            raise ConnectionError(response['error'])
+        return decode_value(response.get('result'))
+
+    def __getattr__(self, name):
+        if name not in DAEMON_METHODS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def program_execute(self, n, console=True):
+        if not isinstance(console, Console):
+            return self.call('program_execute', n, console=console)
+        self.console = console
+        try:
+            return self.call('program_execute', n)
+        finally:
+            self.console = None
+            console.flush()
+
+    def write_program(self, data, slot, name, window=1, retries=2, progress=None, extra_meta={}):
+        self.call('write_program', data, slot, name, window=window, retries=retries, extra_meta=extra_meta)
+        if progress:
+            progress(len(data))
+
+    def rewrite_program(self, data, slot, progress=None, name=None):
+        done = self.call('rewrite_program', data, slot, name=name)
+        if done and progress:
+            progress(len(data))
+        return done
+
+    def shutdown(self):
+        self.call('shutdown')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
 if __name__ == "__main__":
     def handle_list():
         info = rpc.get_storage_information()
@@ -230,60 +1090,328 @@ if __name__ == "__main__":
         print('Please waiting while hub is reconnecting...')
         # todo: Faster exit, maybe kill the serial connections?
 
-    def handle_upload():
+    def read_program():
         with open(args.file, "rb") as f:
-            size = os.path.getsize(args.file)
-            name = args.name if args.name else args.file
-            now = int(time.time() * 1000)
-            start = rpc.start_write_program(name, size, args.to_slot, now, now)
-            bs = start['blocksize']
-            id = start['transferid']
-            with tqdm(total=size, unit='B', unit_scale=True) as pbar:
-                b = f.read(bs)
-                while b:
-                    rpc.write_package(b, id)
-                    pbar.update(len(b))
-                    b = f.read(bs)
-            if args.start:
-                rpc.program_execute(args.to_slot)
+            data = f.read()
+        if args.minify:
+            from minify import prepare
+            data = prepare(data, args.file)[0]
+        return data
+
+    def handle_upload():
+        from tqdm import tqdm
+        data = read_program()
+        name = args.name if args.name else args.file
+        with tqdm(total=len(data), unit='B', unit_scale=True) as pbar:
+            if not (args.fast and rpc.rewrite_program(data, args.to_slot, progress=pbar.update, name=name)):
+                rpc.write_program(data, args.to_slot, name, window=args.window, progress=pbar.update)
+        if args.start:
+            handle_start(args.to_slot)
+
+    def handle_start(slot):
+        log = open(args.log, 'a') if args.log else None
+        console = Console(log=log, timestamps=args.timestamps)
+        try:
+            rpc.program_execute(slot, console)
+        except KeyboardInterrupt:
+            console.flush()
+        finally:
+            if log:
+                log.close()
+        if args.report:
+            print(console.report(), file=sys.stderr)
+
+    def handle_monitor():
+        from telemetry import Telemetry, COLUMN, PORTS
+        telemetry = Telemetry(args.capacity)
+
+        def show(row):
+            ports = []
+            for p in PORTS:
+                values = row[COLUMN[p + '_value0']:COLUMN[p + '_value3'] + 1]
+                ports.append('%s:%s' % (p, ','.join('%g' % v for v in values if v == v)))
+            imu = 'yaw:%g pitch:%g roll:%g' % (row[COLUMN['yaw']], row[COLUMN['pitch']], row[COLUMN['roll']])
+            print(('%s %s' % (' '.join(ports), imu))[:120].ljust(120), end='\r')
+        if not args.quiet:
+            telemetry.subscribe(show)
+        rpc.subscribe(telemetry.process)
+        start_time = time.time()
+        try:
+            while args.duration is None or time.time() - start_time < args.duration:
+                rpc.recv_message(timeout=0.1)
+        except KeyboardInterrupt:
+            pass
+        if not args.quiet:
+            print()
+        print('%d frames received' % telemetry.buffer.count, file=sys.stderr)
+        if args.output:
+            telemetry.save(args.output)
+
+    def fleet_list(rpc, pbar):
+        info = rpc.get_storage_information()
+        storage = info['storage']
+        slots = sorted(int(i) for i in info['slots'])
+        pbar.update(1)
+        return "slots %s; %s/%s%s free" % (','.join(str(i) for i in slots) or '-', storage['free'],
+                                           storage['total'], storage['unit'])
+
+    def fleet_fwinfo(rpc, pbar):
+        info = rpc.get_firmware_info()
+        pbar.update(1)
+        return "firmware %s; runtime %s" % ('.'.join(str(x) for x in info['version']),
+                                            '.'.join(str(x) for x in info['runtime']))
+
+    def fleet_upload(rpc, pbar):
+        data = read_program()
+        pbar.unit, pbar.unit_scale = 'B', True
+        pbar.reset(total=len(data))
+        name = args.name if args.name else args.file
+        if not (args.fast and rpc.rewrite_program(data, args.to_slot, progress=pbar.update, name=name)):
+            rpc.write_program(data, args.to_slot, name, window=args.window, progress=pbar.update)
+        if args.start:
+            rpc.program_execute(args.to_slot, console=False)
+        return "%d bytes to slot %d" % (len(data), args.to_slot)
+
+    def fleet_start(rpc, pbar):
+        rpc.program_execute(args.slot, console=False)
+        pbar.update(1)
+        return "started slot %d" % args.slot
+
+    def fleet_stop(rpc, pbar):
+        rpc.program_terminate()
+        pbar.update(1)
+        return "stopped"
+
+    def sync_args():
+        programs = {}
+        for mapping in args.programs:
+            slot, sep, file = mapping.partition(':')
+            if not sep or not slot.isdigit():
+                parser.error('expected SLOT:FILE, got %s' % mapping)
+            programs[int(slot)] = file
+        return programs, Manifest(os.path.expanduser(args.manifest))
+
+    def handle_sync():
+        from tqdm import tqdm
+        programs, manifest = sync_args()
+        with tqdm(total=sum(os.path.getsize(f) for f in programs.values()), unit='B', unit_scale=True) as pbar:
+            results = sync_programs(rpc, programs, manifest, args.window, args.force, pbar.update)
+        for slot, uploaded in results:
+            print("%2d %-40s %s" % (slot, programs[slot], 'uploaded' if uploaded else 'unchanged'))
+
+    def fleet_sync(rpc, pbar):
+        programs, manifest = fleet_manifest
+        pbar.unit, pbar.unit_scale = 'B', True
+        pbar.reset(total=sum(os.path.getsize(f) for f in programs.values()))
+        results = sync_programs(rpc, programs, manifest, args.window, args.force, pbar.update)
+        return "%d of %d uploaded" % (sum(uploaded for _, uploaded in results), len(results))
+
+    def handle_display_play():
+        def frames():
+            with (sys.stdin if args.file == '-' else open(args.file)) as f:
+                lines = [line.strip() for line in f] if args.loop > 1 else (line.strip() for line in f)
+                for _ in range(args.loop):
+                    for line in lines:
+                        if line and not line.startswith('#'):
+                            yield line
+        stats = rpc.display_play(frames(), args.fps, args.window)
+        print("%d frames shown, %d dropped, %.1f fps; %d messages, %d bytes" %
+              (stats['frames'], stats['dropped'], stats['frames'] / stats['seconds'] if stats['seconds'] else 0,
+               stats['messages'], stats['bytes']), file=sys.stderr)
+
+    def handle_daemon():
+        if args.stop:
+            client = DaemonClient.connect(tty)
+            if client is None:
+                print('No daemon is serving %s' % tty, file=sys.stderr)
+                sys.exit(1)
+            client.shutdown()
+            return
+        try:
+            serve_daemon(tty)
+        except KeyboardInterrupt:
+            pass
+
+    def handle_batch():
+        # Runs the commands of a script over this connection. Consecutive commands that make a single request
+        # (rm, mv, stop and display updates) are sent without waiting for each response, as long as they do not
+        # touch the same slot; others wait for the requests in flight first. Stops at the first error.
+        global args
+        script = args.script
+        steps = []
+        with (sys.stdin if script == '-' else open(script)) as f:
+            for n, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    step = parser.parse_args(shlex.split(line))
+                except SystemExit:
+                    sys.exit('%s:%d: cannot parse %r' % (script, n, line))
+                if step.tty or step.all or step.capture or step.replay or step.stats or 'daemon' in step \
+                        or 'script' in step or ('direct' in step and not isinstance(rpc, RPC)):
+                    sys.exit('%s:%d: %r cannot be used in a batch' % (script, n, line))
+                steps.append((n, line, step))
+        report = []
+        in_flight = []
+        used = set()
+
+        def wait_all():
+            failed = False
+            for n, line, id, start in in_flight:
+                try:
+                    m = rpc.wait_response(id)
+                    if m is None:
+                        raise RPCTimeoutError('No response')
+                    RPC.result(m)
+                    report.append((n, line, time.perf_counter() - start, 'ok'))
+                except ConnectionError as e:
+                    report.append((n, line, time.perf_counter() - start, 'error: %s' % e))
+                    failed = True
+            in_flight.clear()
+            used.clear()
+            return failed
+
+        failed = False
+        pipelined = isinstance(rpc, RPC)
+        if pipelined:
+            rpc.drain()
+        for i, (n, line, step) in enumerate(steps):
+            request = step.request(step) if pipelined and 'request' in step else None
+            if (request is None or request[2] & used) and wait_all():
+                failed = True
+                break
+            start = time.perf_counter()
+            if request is not None:
+                name, params, slots = request
+                in_flight.append((n, line, rpc.send_request(name, params), start))
+                used.update(slots)
+                continue
+            # the handlers read the options of the step from args; the command line ones are restored after it
+            saved, args = args, step
+            try:
+                args.func()
+                report.append((n, line, time.perf_counter() - start, 'ok'))
+            except (Exception, SystemExit) as e:
+                report.append((n, line, time.perf_counter() - start, 'error: %s' % (e or type(e).__name__)))
+                failed = True
+                break
+            finally:
+                args = saved
+        else:
+            failed = wait_all()
+        done = {r[0] for r in report}
+        report += [(n, line, 0, 'not run') for n, line, _ in steps if n not in done]
+        print('%5s %8s  %-40s %s' % ('line', 'seconds', 'command', 'result'), file=sys.stderr)
+        for n, line, seconds, result in sorted(report):
+            print('%5d %8.3f  %-40s %s' % (n, seconds, line[:40], result), file=sys.stderr)
+        if failed:
+            sys.exit(1)
+
+    def handle_fleet():
+        ports = args.tty if args.tty else find_hubs()
+        if not ports:
+            print('No hubs found', file=sys.stderr)
+            sys.exit(1)
+        results = run_fleet(ports, args.fleet, args.jobs)
+        print("%-20s %-6s %7s  %s" % ("Port", "Status", "Time", "Result"))
+        for port, error, elapsed, result in results:
+            if error is not None and not isinstance(error, (ConnectionError, OSError)):
+                error = '%s: %s' % (type(error).__name__, error)
+            print("%-20s %-6s %6.1fs  %s" % (port, 'failed' if error is not None else 'ok', elapsed,
+                                            error if error is not None else result))
+        if any(error is not None for _, error, _, _ in results):
+            sys.exit(1)
 
     parser = argparse.ArgumentParser(description='Tools for Spike Hub RPC protocol')
-    parser.add_argument('-t', '--tty', help='Spike Hub device path', default='/dev/ttyACM0')
+    parser.add_argument('-t', '--tty', help='Spike Hub device path (repeat with --all to select hubs)',
+                        action='append')
+    parser.add_argument('-a', '--all', help='Run on all connected hubs concurrently', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of hubs handled at once with --all (default: all)')
     parser.add_argument('--debug', help='Enable debug', action='store_true')
+    parser.add_argument('--capture', metavar='FILE', help='Record the serial traffic to a trace file')
+    parser.add_argument('--replay', metavar='FILE', help='Play back a trace file instead of talking to the hub')
+    parser.add_argument('--replay-fast', action='store_true', help='Play back as fast as possible, not at the '
+                                                                   'recorded speed')
+    parser.add_argument('--stats', choices=['json', 'prom'],
+                        help='Print per method protocol statistics to stderr at the end (JSON or Prometheus text)')
     parser.set_defaults(func=lambda: parser.print_help())
     sub_parsers = parser.add_subparsers()
 
     list_parser = sub_parsers.add_parser('list', aliases=['ls'], help='List stored programs')
-    list_parser.set_defaults(func=handle_list)
+    list_parser.set_defaults(func=handle_list, fleet=fleet_list)
 
     fwinfo_parser = sub_parsers.add_parser('fwinfo', help='Show firmware version')
-    fwinfo_parser.set_defaults(func=handle_fwinfo)
+    fwinfo_parser.set_defaults(func=handle_fwinfo, fleet=fleet_fwinfo)
 
     reboot_parser = sub_parsers.add_parser('reboot', help='Reboot hub')
-    reboot_parser.set_defaults(func=handle_reboot)
+    reboot_parser.set_defaults(func=handle_reboot, direct=True)
 
     mvprogram_parser = sub_parsers.add_parser('mv', help='Changes program slot')
     mvprogram_parser.add_argument('from_slot', type=int)
     mvprogram_parser.add_argument('to_slot', type=int)
-    mvprogram_parser.set_defaults(func=lambda: rpc.move_project(args.from_slot, args.to_slot))
+    mvprogram_parser.set_defaults(func=lambda: rpc.move_project(args.from_slot, args.to_slot),
+                                  request=lambda a: ('move_project',
+                                                     {'old_slotid': a.from_slot, 'new_slotid': a.to_slot},
+                                                     {a.from_slot, a.to_slot}))
+
+    console_parser = argparse.ArgumentParser(add_help=False)
+    console_parser.add_argument('--log', help='Also append program output to this file')
+    console_parser.add_argument('--timestamps', help='Prefix lines in the log with the time', action='store_true')
+    console_parser.add_argument('--report', help='Show output rate and stalls at the end', action='store_true')
 
-    cpprogram_parser = sub_parsers.add_parser('upload', aliases=['cp'], help='Uploads a program')
+    cpprogram_parser = sub_parsers.add_parser('upload', aliases=['cp'], help='Uploads a program',
+                                              parents=[console_parser])
     cpprogram_parser.add_argument('file')
     cpprogram_parser.add_argument('to_slot', type=int)
     cpprogram_parser.add_argument('name', nargs='?')
     cpprogram_parser.add_argument('--start', '-s', help='Start after upload', action='store_true')
-    cpprogram_parser.set_defaults(func=handle_upload)
+    cpprogram_parser.add_argument('--window', '-w', type=int, default=1,
+                                  help='Number of packages in flight (default: 1)')
+    cpprogram_parser.add_argument('--minify', action='store_true',
+                                  help='Remove comments, docstrings and whitespace before uploading')
+    cpprogram_parser.add_argument('--fast', action='store_true',
+                                  help='Replace the program in an occupied slot in binary through hub/fastxfer.py '
+                                       'when it is installed on the hub')
+    cpprogram_parser.set_defaults(func=handle_upload, fleet=fleet_upload)
+
+    sync_parser = sub_parsers.add_parser('sync', help='Uploads the programs that differ from the ones in their slots')
+    sync_parser.add_argument('programs', nargs='+', metavar='SLOT:FILE')
+    sync_parser.add_argument('--window', '-w', type=int, default=1,
+                             help='Number of packages in flight (default: 1)')
+    sync_parser.add_argument('--force', '-f', help='Upload even if unchanged', action='store_true')
+    sync_parser.add_argument('--manifest', help='File remembering uploaded program hashes',
+                             default='~/.spike-tools/manifest.json')
+    sync_parser.set_defaults(func=handle_sync, fleet=fleet_sync)
 
     rmprogram_parser = sub_parsers.add_parser('rm', help='Removes the program at a given slot')
     rmprogram_parser.add_argument('from_slot', type=int)
-    rmprogram_parser.set_defaults(func=lambda: rpc.remove_project(args.from_slot))
+    rmprogram_parser.set_defaults(func=lambda: rpc.remove_project(args.from_slot),
+                                  request=lambda a: ('remove_project', {'slotid': a.from_slot}, {a.from_slot}))
 
-    startprogram_parser = sub_parsers.add_parser('start', help='Starts a program')
+    startprogram_parser = sub_parsers.add_parser('start', help='Starts a program', parents=[console_parser])
     startprogram_parser.add_argument('slot', type=int)
-    startprogram_parser.set_defaults(func=lambda: rpc.program_execute(args.slot))
+    startprogram_parser.set_defaults(func=lambda: handle_start(args.slot), fleet=fleet_start)
 
     stopprogram_parser = sub_parsers.add_parser('stop', help='Stop program execution')
-    stopprogram_parser.set_defaults(func=lambda: rpc.program_terminate())
+    stopprogram_parser.set_defaults(func=lambda: rpc.program_terminate(), fleet=fleet_stop,
+                                    request=lambda a: ('program_terminate', {}, set()))
+
+    monitor_parser = sub_parsers.add_parser('monitor', help='Records sensor, motor and IMU state')
+    monitor_parser.add_argument('-o', '--output', help='save the recorded frames to a .npy or .csv file')
+    monitor_parser.add_argument('-d', '--duration', type=float, help='stop after this many seconds')
+    monitor_parser.add_argument('-n', '--capacity', type=int, default=100000,
+                                help='number of most recent frames kept (default: 100000)')
+    monitor_parser.add_argument('-q', '--quiet', help='do not print frames', action='store_true')
+    monitor_parser.set_defaults(func=handle_monitor, direct=True)
+
+    daemon_parser = sub_parsers.add_parser('daemon', help='Keeps the hub connection open for later commands')
+    daemon_parser.add_argument('--stop', help='Stop the daemon', action='store_true')
+    daemon_parser.set_defaults(func=handle_daemon, daemon=True)
+
+    batch_parser = sub_parsers.add_parser('batch', help='Runs the commands in a script over one connection')
+    batch_parser.add_argument('script', help='file with one command per line (as given to this tool), - for stdin')
+    batch_parser.set_defaults(func=handle_batch)
 
     display_parser = sub_parsers.add_parser('display', help='Controls 5x5 LED matrix display')
     display_parser.set_defaults(func=lambda: display_parser.print_help())
@@ -292,23 +1420,75 @@ if __name__ == "__main__":
     display_image_parser = display_parsers.add_parser('image', help='Displays image on the LED matrix')
     display_image_parser.add_argument('image',
                                       help='format xxxxx:xxxxx:xxxxx:xxxxx:xxxx, where x is the pixel brigthness in range 0-9')
-    display_image_parser.set_defaults(func=lambda: rpc.display_image(args.image))
+    display_image_parser.set_defaults(func=lambda: rpc.display_image(args.image),
+                                      request=lambda a: ('scratch.display_image', {'image': a.image}, set()))
 
     display_text_parser = display_parsers.add_parser('text', help='Displays scrolling text on the LED matrix')
     display_text_parser.add_argument('text')
-    display_text_parser.set_defaults(func=lambda: rpc.display_text(args.text))
+    display_text_parser.set_defaults(func=lambda: rpc.display_text(args.text),
+                                     request=lambda a: ('scratch.display_text', {'text': a.text}, set()))
 
     display_clear_parser = display_parsers.add_parser('clear', help='Clears display')
-    display_clear_parser.set_defaults(func=lambda: rpc.display_clear())
+    display_clear_parser.set_defaults(func=lambda: rpc.display_clear(),
+                                      request=lambda a: ('scratch.display_clear', {}, set()))
 
     display_pixel_parser = display_parsers.add_parser('setpixel', help='Sets individual LED brightness')
     display_pixel_parser.add_argument('x', type=int)
     display_pixel_parser.add_argument('y', type=int)
     display_pixel_parser.add_argument('brightness', nargs='?', type=int, default=9, help='pixel brightness 0-9')
-    display_pixel_parser.set_defaults(func=lambda: rpc.display_set_pixel(args.x, args.y, args.brightness))
+    display_pixel_parser.set_defaults(func=lambda: rpc.display_set_pixel(args.x, args.y, args.brightness),
+                                      request=lambda a: ('scratch.display_set_pixel',
+                                                         {'x': a.x, 'y': a.y, 'brightness': a.brightness}, set()))
+
+    display_play_parser = display_parsers.add_parser('play', help='Plays an animation on the LED matrix')
+    display_play_parser.add_argument('file', help='file with one image per line (format as for image), - for stdin')
+    display_play_parser.add_argument('--fps', '-f', type=float, default=10, help='frames per second (default: 10)')
+    display_play_parser.add_argument('--window', '-w', type=int, default=8,
+                                     help='Number of display updates in flight (default: 8)')
+    display_play_parser.add_argument('--loop', '-l', type=int, default=1, help='play the animation this many times')
+    display_play_parser.set_defaults(func=handle_display_play, direct=True)
 
     args = parser.parse_args()
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
-    rpc = RPC(args.tty)
-    args.func()
+    if (args.capture or args.replay) and (args.all or 'daemon' in args):
+        parser.error('--capture and --replay cannot be used with --all or daemon')
+    if args.all:
+        if 'fleet' not in args:
+            parser.error('this command cannot be used with --all')
+        if args.fleet is fleet_sync:
+            fleet_manifest = sync_args()
+        handle_fleet()
+        sys.exit()
+    if args.tty and len(args.tty) > 1:
+        parser.error('more than one --tty requires --all')
+    tty = args.tty[0] if args.tty else '/dev/ttyACM0'
+    if 'daemon' in args:
+        args.func()
+        sys.exit()
+    rpc = DaemonClient.connect(tty) if not args.replay else None
+    if rpc is not None and args.capture:
+        # the daemon reads the port, a second reader would take bytes from it
+        parser.error('--capture cannot be used while a daemon is serving %s' % tty)
+    if rpc is not None and 'direct' in args:
+        parser.error('this command cannot be used while a daemon is serving %s' % tty)
+    if rpc is None:
+        if args.replay:
+            from serialtrace import ReplaySerial
+            rpc = RPC(ser=ReplaySerial(args.replay, args.replay_fast))
+        else:
+            rpc = RPC(tty)
+        if args.capture:
+            from serialtrace import CaptureSerial
+            rpc.ser = CaptureSerial(rpc.ser, args.capture)
+        if args.stats:
+            rpc.stats = Stats()
+    elif args.stats:
+        print('Statistics are not available while a daemon is serving %s' % tty, file=sys.stderr)
+    try:
+        args.func()
+    finally:
+        if isinstance(rpc, RPC) and rpc.stats is not None:
+            print(rpc.stats.json() if args.stats == 'json' else rpc.stats.prometheus(), file=sys.stderr)
+        if args.capture:
+            rpc.close()
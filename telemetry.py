@@ -0,0 +1,83 @@
+import time
+import numpy as np
+
+PORTS = 'ABCDEF'
+PORT_VALUES = 4
+
+# Layout of a telemetry row. Port values of a m:0 frame are padded with NaN to PORT_VALUES, the battery
+# columns hold the last m:2 frame received.
+COLUMNS = ['time'] + \
+          ['%s_%s' % (p, v) for p in PORTS for v in ['type'] + ['value%d' % i for i in range(PORT_VALUES)]] + \
+          ['accel_x', 'accel_y', 'accel_z', 'gyro_x', 'gyro_y', 'gyro_z', 'yaw', 'pitch', 'roll', 'hub_time',
+           'battery_voltage', 'battery_level']
+COLUMN = {name: i for i, name in enumerate(COLUMNS)}
+_IMU = COLUMN['accel_x']
+_HUB_TIME = COLUMN['hub_time']
+_BATTERY = COLUMN['battery_voltage']
+
+
+# Fixed size ring buffer with one float64 column per value. Memory use is capacity * len(COLUMNS) * 8 bytes
+# regardless of how long the hub has been running.
+class RingBuffer:
+    def __init__(self, capacity, columns=len(COLUMNS)):
+        self.data = np.full((capacity, columns), np.nan)
+        self.capacity = capacity
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def next_row(self):
+        row = self.data[self.count % self.capacity]
+        self.count += 1
+        return row
+
+    def array(self):
+        # rows in arrival order, oldest first
+        if self.count <= self.capacity:
+            return self.data[:self.count]
+        i = self.count % self.capacity
+        return np.concatenate((self.data[i:], self.data[:i]))
+
+
+class Telemetry:
+    def __init__(self, capacity=100000):
+        self.buffer = RingBuffer(capacity)
+        self.battery = (np.nan, np.nan)
+        self.callbacks = []
+
+    def subscribe(self, callback):
+        # callback(row) is called with each decoded row, a view valid until the buffer wraps around
+        self.callbacks.append(callback)
+
+    def column(self, name):
+        return self.buffer.array()[:, COLUMN[name]]
+
+    def process(self, msg):
+        if msg['m'] == 2:
+            p = msg['p']
+            self.battery = (p[0], p[1])
+            return
+        p = msg['p']
+        row = self.buffer.next_row()
+        row.fill(np.nan)
+        row[0] = time.time()
+        for i in range(len(PORTS)):
+            port = p[i]
+            base = 1 + i * (PORT_VALUES + 1)
+            row[base] = port[0]
+            values = port[1][:PORT_VALUES]
+            # values can be None for sensors that do not detect anything
+            row[base + 1:base + 1 + len(values)] = [v if isinstance(v, (int, float)) else np.nan for v in values]
+        row[_IMU:_IMU + 9] = p[6] + p[7] + p[8]
+        if len(p) > 10 and isinstance(p[10], (int, float)):
+            row[_HUB_TIME] = p[10]
+        row[_BATTERY:_BATTERY + 2] = self.battery
+        for callback in self.callbacks:
+            callback(row)
+
+    def save(self, path):
+        if path.endswith('.csv'):
+            np.savetxt(path, self.buffer.array(), delimiter=',', header=','.join(COLUMNS), comments='')
+        else:
+            np.save(path, self.buffer.array())
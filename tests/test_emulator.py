@@ -0,0 +1,141 @@
+# Smoke tests of the tools against the hub emulator: python -m pytest tests
+import io
+import os
+import sys
+import time
+import shutil
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from cp import Repl
+from emulator import Emulator
+from spikejsonrpc import RPC
+
+
+@pytest.fixture
+def emulator():
+    with Emulator() as emulator:
+        yield emulator
+
+
+@pytest.fixture
+def rpc(emulator):
+    rpc = RPC(emulator.port)
+    yield rpc
+    rpc.close()
+
+
+@pytest.fixture
+def repl(emulator):
+    repl = Repl.open(emulator.port)
+    repl.enter()
+    yield repl
+    repl.close()
+    repl.ser.close()
+
+
+def test_rpc_queries(rpc):
+    assert rpc.get_firmware_info()['version'] == [1, 0, 6, 34]
+    assert rpc.get_storage_information()['slots'] == {}
+
+
+def test_rpc_write_program(rpc, emulator):
+    data = b'print("hello")\n' * 100
+    rpc.write_program(data, 3, 'hello.py', window=4)
+    slot = rpc.get_storage_information()['slots']['3']
+    assert slot['name'] == 'hello.py' and slot['size'] == len(data)
+    assert emulator.slots[3]['data'] == data
+
+
+class SlowStartEmulator(Emulator):
+    def rpc_start_write_program(self, **params):
+        time.sleep(0.6)
+        return super().rpc_start_write_program(**params)
+
+
+def test_rpc_slow_method():
+    # a method much slower than the queries before it must not time out
+    with SlowStartEmulator() as emulator:
+        rpc = RPC(emulator.port)
+        try:
+            rpc.get_storage_information()
+            rpc.write_program(b'pass\n', 4, 'slow.py')
+            assert emulator.slots[4]['data'] == b'pass\n'
+            assert not emulator.transfers
+        finally:
+            rpc.close()
+
+
+class RestartingEmulator(Emulator):
+    # ignores JSON RPC requests for a while after a soft reboot, like a restarting runtime
+    def soft_reboot(self):
+        super().soft_reboot()
+        self.restarting_until = time.time() + 1
+
+    def dispatch(self, msg):
+        if time.time() >= getattr(self, 'restarting_until', 0):
+            super().dispatch(msg)
+
+
+def test_rpc_rewrite_program():
+    with RestartingEmulator() as emulator:
+        shutil.copy(os.path.join(ROOT, 'hub', 'fastxfer.py'), emulator.root)
+        rpc = RPC(emulator.port)
+        try:
+            rpc.write_program(b'pass\n', 1, 'old.py')
+            slot = rpc.get_storage_information()['slots']['1']
+            os.makedirs(os.path.join(emulator.root, 'projects', str(slot['id'])))
+            with open(os.path.join(emulator.root, 'projects', '.slots'), 'w') as f:
+                f.write(repr({1: {'name': 'old.py', 'id': slot['id'], 'size': 5, 'modified': 0}}))
+            assert rpc.rewrite_program(b'print(1)\n', 1, name='new.py')
+            # the runtime has restarted and answers again
+            rpc.send_message('program_modechange', {'mode': 'download'})
+            with open(os.path.join(emulator.root, 'projects', str(slot['id']), '__init__.py'), 'rb') as f:
+                assert f.read() == b'print(1)\n'
+            with open(os.path.join(emulator.root, 'projects', '.slots')) as f:
+                assert eval(f.read())[1]['name'] == 'new.py'
+        finally:
+            rpc.close()
+
+
+def test_rpc_after_idle():
+    # state frames sent while no client reads the port must not delay the first responses
+    with Emulator(baudrate=115200, state_interval=0.005) as emulator:
+        time.sleep(1.5)
+        rpc = RPC(emulator.port)
+        try:
+            start = time.time()
+            rpc.get_firmware_info()
+            assert time.time() - start < 1
+        finally:
+            rpc.close()
+
+
+def test_repl_put_get(repl):
+    data = os.urandom(5000)
+    repl.put_raw(io.BytesIO(data), '/data.bin', 1024)
+    assert repl.listdir('/') == [('/data.bin', len(data))]
+    f = io.BytesIO()
+    repl.get('/data.bin', f, 1024)
+    assert f.getvalue() == data
+
+
+def test_repl_without_raw_paste():
+    with Emulator(raw_paste=False) as emulator:
+        repl = Repl.open(emulator.port)
+        try:
+            repl.enter()
+            repl.put_raw(io.BytesIO(b'y = 2\n'), '/y.py')
+            assert repl.listdir('/') == [('/y.py', 6)]
+            assert not repl.use_raw_paste
+        finally:
+            repl.close()
+            repl.ser.close()
+
+
+def test_repl_put_lines(repl, emulator):
+    repl.put_lines(io.BytesIO(b'x = 1\n'), '/x.py')
+    with open(os.path.join(emulator.root, 'x.py'), 'rb') as f:
+        assert f.read() == b'x = 1\n'